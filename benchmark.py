@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Measures the service against stores seeded with 1k, 10k and 100k
+# reports: concurrent harness runners going through start, PUT and stop,
+# then microbenchmarks of the functions behind the routes. Results, p50
+# and p99 latency in milliseconds and operations per second, are written
+# as JSON so runs on different commits can be compared.
+#
+#    REPORT_STORE=json ./benchmark.py [--sizes 1000,10000] [--runners 8]
+#        [--seconds 10] [--output benchmark.json] [--compare old.json]
+#    ./benchmark.py --url http://localhost:5000 --runners 8
+#
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+ZONES = ['us-south-1', 'us-south-2', 'us-south-3', 'eu-de-1', 'eu-gb-2']
+TEST_TYPES = ['1nic', '2nic', '3nic']
+IMAGE_NAMES = ['bigip14-1', 'bigip15-1', 'bigip16-0']
+
+STOP_RESULTS = {
+    'version': '14.1',
+    'product': 'BIGIP',
+    'hostname': 'benchmark.local',
+    'management': '192.168.245.119/24',
+    'installed_extensions': ['f5-service-discovery', 'f5-declarative-onboarding', 'f5-appsvcs', 'f5-telemetry'],
+    'as3_enabled': True,
+    'do_enabled': False,
+    'ts_enabled': False
+}
+
+
+def seed_reports(count, seed=1):
+    # completed reports spread over the last 30 days, with a few running
+    generator = random.Random(seed)
+    now = time.time()
+    reports = {}
+    for index in range(count):
+        start_time = now - generator.random() * 30 * 86400
+        report = {
+            'zone': generator.choice(ZONES),
+            'type': generator.choice(TEST_TYPES),
+            'image_name': generator.choice(IMAGE_NAMES),
+            'start_time': start_time,
+            'readable_start_time': datetime.datetime.utcfromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S UTC'),
+            'stop_time': None,
+            'readable_stop_time': None,
+            'duration': 0,
+            'results': {}
+        }
+        if generator.random() < 0.98:
+            duration = generator.lognormvariate(6, 0.5)
+            plan = generator.lognormvariate(3, 0.3)
+            apply = generator.lognormvariate(5, 0.4)
+            report.update({
+                'workspace_create_result_code': 0,
+                'workspace_create_duration': generator.lognormvariate(1, 0.3),
+                'terraform_plan_result_code': 0,
+                'terraform_plan_duration': plan,
+                'terraform_apply_result_code': generator.choice([0] * 9 + [1]),
+                'terraform_apply_duration': apply,
+                'terraform_result_code': 0,
+                'terraform_apply_stop': start_time + plan + apply,
+                'terraform_output': 'Apply complete! Resources: 12 added, 0 changed, 0 destroyed.',
+                'stop_time': start_time + duration,
+                'readable_stop_time': datetime.datetime.utcfromtimestamp(start_time + duration).strftime('%Y-%m-%d %H:%M:%S UTC'),
+                'duration': duration
+            })
+            results = dict(STOP_RESULTS)
+            results['status'] = generator.choice(['SUCCESS'] * 9 + ['FAIL'])
+            report['results'] = results
+        reports[str(uuid.UUID(int=generator.getrandbits(128), version=4))] = report
+    return reports
+
+
+def statistics(latencies, elapsed=None):
+    # latencies in seconds, elapsed the wall time the operations shared
+    # when they ran concurrently
+    if not latencies:
+        return {'count': 0}
+    latencies = sorted(latencies)
+    if elapsed is None:
+        elapsed = sum(latencies)
+
+    def percentile(quantile):
+        return round(latencies[int(quantile * (len(latencies) - 1))] * 1000, 3)
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'ops_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0
+    }
+
+
+class TestClient(object):
+    """The Flask test client driving the application in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, data=body,
+                                    content_type='application/json')
+        return response.status_code
+
+
+class HttpClient(object):
+    """A requests session against a running service."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, body=None):
+        response = self.session.request(method, self.url + path, data=body,
+                                        headers={'Content-Type': 'application/json'})
+        return response.status_code
+
+
+def run_harness(client, deadline, latencies, errors):
+    # one simulated harness runner, going through the lifecycle of a test
+    # run after run until the deadline
+    generator = random.Random()
+    while time.time() < deadline:
+        test_id = str(uuid.uuid4())
+        start = {
+            'zone': generator.choice(ZONES),
+            'type': generator.choice(TEST_TYPES),
+            'image_name': generator.choice(IMAGE_NAMES)
+        }
+        update = {
+            'terraform_result_code': 0,
+            'terraform_apply_stop': time.time(),
+            'terraform_output': 'Apply complete! Resources: 12 added, 0 changed, 0 destroyed.'
+        }
+        stop = dict(STOP_RESULTS)
+        stop['status'] = 'SUCCESS'
+        steps = [
+            ('start', 'POST', '/start/' + test_id, start),
+            ('update', 'PUT', '/report/' + test_id, update),
+            ('stop', 'POST', '/stop/' + test_id, stop),
+            ('summary', 'GET', '/summary', None),
+            ('query', 'GET', '/query?zone=us-south&failed=1', None)
+        ]
+        for name, method, path, body in steps:
+            began = time.perf_counter()
+            try:
+                status = client.request(method, path, json.dumps(body) if body is not None else None)
+            except Exception as ex:
+                errors.append('%s: %r' % (name, ex))
+                continue
+            latencies.setdefault(name, []).append(time.perf_counter() - began)
+            if status != 200:
+                errors.append('%s: status %d' % (name, status))
+
+
+def run_lifecycle(make_client, runners, seconds):
+    deadline = time.time() + seconds
+    latencies = [{} for runner in range(runners)]
+    errors = []
+    threads = []
+    began = time.perf_counter()
+    for runner in range(runners):
+        thread = threading.Thread(target=run_harness,
+                                  args=(make_client(), deadline, latencies[runner], errors))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    merged = {}
+    for runner_latencies in latencies:
+        for name, values in runner_latencies.items():
+            merged.setdefault(name, []).extend(values)
+    results = {}
+    for name, values in merged.items():
+        results[name] = statistics(values, elapsed)
+    results['errors'] = len(errors)
+    return results
+
+
+def measure(function, seconds, minimum=5):
+    # call function repeatedly for about seconds, at least minimum times,
+    # after one unmeasured call rebuilds anything an earlier benchmark
+    # dropped
+    function()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while len(latencies) < minimum or time.perf_counter() < deadline:
+        began = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - began)
+    return statistics(latencies)
+
+
+def run_microbenchmarks(server, seconds):
+    app = server.app
+    template = seed_reports(1, seed=2)
+    report = list(template.values())[0]
+
+    def add_report():
+        server.add_report(str(uuid.uuid4()), dict(report))
+
+    def route(function, path):
+        def call():
+            with app.test_request_context(path):
+                function()
+        return call
+
+    def cold(function):
+        # the same call with nothing cached, as after a restart
+        def call():
+            with server._cache_lock:
+                server._report_cache['reports'] = None
+            function()
+        return call
+    benchmarks = [
+        ('add_report', add_report),
+        ('read_reports', server.read_reports),
+        ('read_reports_cold', cold(server.read_reports)),
+        ('store_load', server.STORE.load),
+        ('summary', route(server.summary, '/summary')),
+        ('summary_scan', route(server.summary, '/summary?scan=1')),
+        ('query_attributes', route(server.query_attributes, '/query?zone=us-south&failed=1')),
+        ('query_attributes_scan', route(server.query_attributes, '/query?zone=us-south&failed=1&scan=1')),
+        ('failed_reports', route(server.failed_reports, '/failed')),
+        ('running_reports', route(server.running_reports, '/running'))
+    ]
+    if server.numpy is not None:
+        benchmarks.extend([
+            ('summary_columnar', route(server.summary, '/summary?engine=columnar')),
+            ('query_attributes_columnar', route(server.query_attributes, '/query?zone=us-south&failed=1&engine=columnar')),
+            ('failed_reports_columnar', route(server.failed_reports, '/failed?engine=columnar')),
+            ('running_reports_columnar', route(server.running_reports, '/running?engine=columnar'))
+        ])
+    results = {}
+    for name, function in benchmarks:
+        results[name] = measure(function, seconds)
+    return results
+
+
+def run_size(size, runners, seconds):
+    # in a fresh process and directory so every size starts from a cold
+    # store and cache
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    server.STORE.open()
+    began = time.perf_counter()
+    with server.STORE.lock():
+        server.STORE.write(list(seed_reports(size).items()))
+    seeded = time.perf_counter() - began
+    began = time.perf_counter()
+    server.read_reports()
+    server.read_view('indexes', lambda view, reports: None)
+    server.read_view('summary', lambda view, reports: None)
+    if server.numpy is not None:
+        server.read_view('columns', lambda view, reports: None)
+    first_read = time.perf_counter() - began
+    results = {
+        'seed_seconds': round(seeded, 3),
+        'first_read_seconds': round(first_read, 3),
+        'lifecycle': run_lifecycle(lambda: TestClient(server.app), runners, seconds),
+        'micro': run_microbenchmarks(server, max(seconds / 8.0, 0.5))
+    }
+    server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def compare(previous, current):
+    # ratio of each p50 and ops/sec to the previous run
+    for size, results in current['results'].items():
+        if size not in previous['results']:
+            continue
+        for group in ['lifecycle', 'micro']:
+            for name, stats in results.get(group, {}).items():
+                old = previous['results'][size].get(group, {}).get(name)
+                if not isinstance(stats, dict) or not old or not old.get('count') or not stats.get('count'):
+                    continue
+                print('%8s %-10s %-24s p50 %8.3f -> %8.3f ms  ops/sec %9.1f -> %9.1f' % (
+                    size, group, name, old['p50_ms'], stats['p50_ms'],
+                    old['ops_per_sec'], stats['ops_per_sec']))
+
+
+def report_results(results):
+    for size, size_results in results['results'].items():
+        for group in ['lifecycle', 'micro']:
+            for name, stats in size_results.get(group, {}).items():
+                if isinstance(stats, dict) and stats.get('count'):
+                    print('%8s %-10s %-24s p50 %8.3f ms  p99 %8.3f ms  %9.1f ops/sec' % (
+                        size, group, name, stats['p50_ms'], stats['p99_ms'], stats['ops_per_sec']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the report service')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated numbers of reports to seed the store with')
+    parser.add_argument('--runners', type=int, default=8,
+                        help='concurrent simulated harness runners')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='how long the runners go on for each size')
+    parser.add_argument('--url', help='drive a running service over HTTP instead, without seeding it')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    arguments = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'time': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'store': os.getenv('REPORT_STORE', 'json'),
+        'group_commit': os.getenv('GROUP_COMMIT', 'false'),
+        'python': sys.version.split()[0],
+        'runners': arguments.runners,
+        'seconds': arguments.seconds,
+        'results': {}
+    }
+    if arguments.url:
+        results['url'] = arguments.url
+        results['results']['remote'] = {
+            'lifecycle': run_lifecycle(lambda: HttpClient(arguments.url),
+                                       arguments.runners, arguments.seconds)
+        }
+    else:
+        context = multiprocessing.get_context('spawn')
+        for size in [int(size) for size in arguments.sizes.split(',')]:
+            # a fresh process per size, Pool rather than ProcessPoolExecutor
+            # whose mp_context needs Python 3.7
+            with context.Pool(1) as pool:
+                results['results'][str(size)] = pool.apply(
+                    run_size, (size, arguments.runners, arguments.seconds))
+    report_results(results)
+    with open(arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4, sort_keys=True)
+    if arguments.compare:
+        with open(arguments.compare) as previous_file:
+            compare(json.load(previous_file), results)
+
+
+if __name__ == '__main__':
+    main()
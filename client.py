@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Client for harness nodes reporting to the service. Writes are buffered
+# and sent together through POST /batch over pooled keep-alive
+# connections, retried with jittered backoff while the service is
+# unavailable and spooled to disk if it stays unavailable, to be sent
+# once it is back.
+#
+#    with ReportClient('http://localhost:5000', spool_directory='./spool') as client:
+#        client.start(test_id, {'zone': 'us-south-3', 'type': '1nic', 'image_name': 'bigip14-1'})
+#        client.update(test_id, {'terraform_result_code': 0})
+#        client.stop(test_id, {'status': 'SUCCESS'})
+#
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import tempfile
+import threading
+
+import urllib3
+import requests
+import requests.adapters
+
+LOG = logging.getLogger(__name__)
+
+# statuses worth trying again, the service restarting or overloaded
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+class ServiceUnavailable(Exception):
+    """The service could not be reached within the retries allowed.
+    status is that of the last answer, None when it failed to connect, and
+    uncertain is set when the last attempt may have been applied."""
+
+    def __init__(self, message, status=None, uncertain=False):
+        super(ServiceUnavailable, self).__init__(message)
+        self.status = status
+        self.uncertain = uncertain
+
+
+def _not_sent(ex):
+    # the connection was never made, so the request did not reach the service
+    if isinstance(ex, requests.ConnectTimeout):
+        return True
+    reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class ReportClient(object):
+    """Pooled, batching client for the report service, safe to share
+    between threads.
+
+    start, update, stop and delete are buffered and sent in batches of up
+    to batch_size operations, at the latest flush_interval seconds after
+    they were made, or on flush. At most max_in_flight requests are sent
+    at once. Reads flush the buffer first so they see earlier writes.
+    Operations the service rejects are kept in failures, as are those of
+    a spooled batch answered with a server error spool_attempts times.
+    """
+
+    def __init__(self, base_url='http://localhost:5000', pool_size=10,
+                 max_in_flight=10, batch_size=100, flush_interval=0.5,
+                 retries=5, backoff=0.25, backoff_cap=10.0, timeout=30,
+                 spool_directory=None, spool_attempts=3):
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.spool_directory = spool_directory
+        self.spool_attempts = spool_attempts
+        # failed replays of each spooled batch, by the name it sorts under
+        self.spool_failures = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.buffer = []
+        self.condition = threading.Condition()
+        # one flush at a time keeps operations in the order they were made
+        self.flush_lock = threading.Lock()
+        self.failures = []
+        # whether the first buffered batch may already have been applied
+        self.uncertain = False
+        self.closed = False
+        self.flusher = None
+        if flush_interval:
+            self.flusher = threading.Thread(target=self._run, name='report-flusher',
+                                            daemon=True)
+            self.flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, method, path, applied=None, uncertain=False, **kwargs):
+        # retry connection failures and RETRY_STATUSES with full jitter
+        # exponential backoff. A request that is not idempotent passes
+        # applied, asked before sending it again after an attempt that may
+        # have reached the service, and None is returned if it took effect
+        attempt = 0
+        while True:
+            if uncertain and applied is not None:
+                try:
+                    if applied():
+                        return None
+                except ServiceUnavailable as ex:
+                    raise ServiceUnavailable(str(ex), ex.status, True)
+            status = None
+            try:
+                with self.in_flight:
+                    response = self.session.request(method, self.base_url + path,
+                                                    timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                status = response.status_code
+                error = 'status %d' % status
+                uncertain = True
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = repr(ex)
+                uncertain = not _not_sent(ex)
+            if attempt >= self.retries:
+                raise ServiceUnavailable('%s %s: %s' % (method, path, error),
+                                         status, uncertain)
+            time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt)))
+            attempt = attempt + 1
+
+    def _queue(self, operation):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('client is closed')
+            self.buffer.append(operation)
+            full = len(self.buffer) >= self.batch_size
+            if full:
+                self.condition.notify()
+        if full and not self.flusher:
+            self.flush()
+
+    def start(self, test_id, report):
+        self._queue({'op': 'start', 'id': str(test_id), 'data': report})
+
+    def update(self, test_id, fields):
+        self._queue({'op': 'update', 'id': str(test_id), 'data': fields})
+
+    def patch(self, test_id, patch):
+        # a JSON merge patch, null removing a field
+        self._queue({'op': 'patch', 'id': str(test_id), 'data': patch})
+
+    def stop(self, test_id, results):
+        self._queue({'op': 'stop', 'id': str(test_id), 'data': results})
+
+    def delete(self, test_id):
+        self._queue({'op': 'delete', 'id': str(test_id)})
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.buffer) < self.batch_size and not self.closed:
+                    # give the batch until flush_interval to fill
+                    self.condition.wait(self.flush_interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception('flushing reports failed')
+            if closed:
+                return
+
+    def _applied(self, operations):
+        # batches are applied whole, so one that may have reached the
+        # service took effect when the first test it starts exists. Every
+        # test is started once, under an id of its own
+        for operation in operations:
+            if operation.get('op') == 'start':
+                response = self._request('GET', '/report/%s' % operation['id'],
+                                         params={'fields': 'start_time'})
+                return response.status_code == 200
+        return False
+
+    def _send(self, operations, uncertain=False):
+        # the per operation results of one batch, operations the service
+        # rejected are kept in failures rather than retried. uncertain
+        # when an earlier attempt may have applied the batch
+        applied = None
+        if any(operation.get('op') == 'start' for operation in operations):
+            # starting a test again would reset its start_time
+            applied = lambda: self._applied(operations)
+        response = self._request('POST', '/batch', applied=applied,
+                                 uncertain=uncertain, json=operations)
+        if response is None:
+            # applied by an attempt whose answer was lost
+            return []
+        if response.status_code != 200:
+            # rejected as a whole, sending it again would not help
+            LOG.error('batch of %d operations rejected with status %d',
+                      len(operations), response.status_code)
+            for operation in operations:
+                self.failures.append((operation, response.status_code))
+            return []
+        results = response.json()
+        for operation, result in zip(operations, results):
+            if result.get('status') != 200:
+                self.failures.append((operation, result.get('status')))
+        return results
+
+    def flush(self):
+        # send everything buffered, spooled batches first. Returns how
+        # many operations were sent, raising ServiceUnavailable when they
+        # could not be sent and there is no spool to keep them in
+        with self.flush_lock:
+            sent = 0
+            operations = []
+            try:
+                sent = self._replay_spool()
+                while True:
+                    with self.condition:
+                        operations = self.buffer[:self.batch_size]
+                        del self.buffer[:self.batch_size]
+                    if not operations:
+                        return sent
+                    uncertain = self.uncertain
+                    self.uncertain = False
+                    self._send(operations, uncertain)
+                    sent = sent + len(operations)
+            except ServiceUnavailable as ex:
+                with self.condition:
+                    remaining = list(self.buffer)
+                    del self.buffer[:]
+                    if not self.spool_directory:
+                        # the same batch is taken from the front next time
+                        self.buffer[:0] = operations + remaining
+                        self.uncertain = bool(operations) and ex.uncertain
+                        raise
+                # a batch that may have been applied is spooled on its own,
+                # so the operations never sent are not checked against it
+                if operations:
+                    self._spool(operations, ex.uncertain)
+                if remaining:
+                    self._spool(remaining)
+                return sent
+
+    def _spool_files(self):
+        if not self.spool_directory or not os.path.isdir(self.spool_directory):
+            return []
+        return sorted(name for name in os.listdir(self.spool_directory)
+                      if name.endswith('.spool.json'))
+
+    def _spool(self, operations, uncertain=False):
+        # written whole and renamed into place, named so they sort in the
+        # order they were made. A batch that may have been applied is
+        # marked .sent and checked before it is sent again
+        os.makedirs(self.spool_directory, exist_ok=True)
+        name = '%020d-%s%s.spool.json' % (time.time() * 1000000, uuid.uuid4().hex[:8],
+                                          '.sent' if uncertain else '')
+        descriptor, temp_file = tempfile.mkstemp(dir=self.spool_directory)
+        with os.fdopen(descriptor, 'w') as spool_file:
+            json.dump(operations, spool_file)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(temp_file, os.path.join(self.spool_directory, name))
+        LOG.warning('service unavailable, spooled %d operations to %s',
+                    len(operations), name)
+
+    def _replay_spool(self):
+        sent = 0
+        for name in self._spool_files():
+            path = os.path.join(self.spool_directory, name)
+            with open(path) as spool_file:
+                operations = json.load(spool_file)
+            key = name.split('.')[0]
+            uncertain = name.endswith('.sent.spool.json')
+            try:
+                self._send(operations, uncertain)
+            except ServiceUnavailable as ex:
+                if ex.uncertain and not uncertain:
+                    sent_path = os.path.join(self.spool_directory, key + '.sent.spool.json')
+                    os.replace(path, sent_path)
+                    path = sent_path
+                if ex.status is None:
+                    raise
+                # the service answers but fails on this batch; after
+                # spool_attempts replays it is moved aside to .failed.json
+                # so the batches behind it are not held up
+                self.spool_failures[key] = self.spool_failures.get(key, 0) + 1
+                if self.spool_failures[key] < self.spool_attempts:
+                    raise
+                del self.spool_failures[key]
+                os.replace(path, os.path.join(self.spool_directory, key + '.failed.json'))
+                LOG.error('spooled batch %s failed with status %d %d times, moved aside',
+                          key, ex.status, self.spool_attempts)
+                for operation in operations:
+                    self.failures.append((operation, ex.status))
+                continue
+            os.unlink(path)
+            self.spool_failures.pop(key, None)
+            sent = sent + len(operations)
+        return sent
+
+    def spooled(self):
+        # number of operations waiting in the spool
+        count = 0
+        for name in self._spool_files():
+            with open(os.path.join(self.spool_directory, name)) as spool_file:
+                count = count + len(json.load(spool_file))
+        return count
+
+    def _get(self, path, params=None):
+        self.flush()
+        response = self._request('GET', path, params=params)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def report(self, test_id, **params):
+        return self._get('/report/%s' % test_id, params)
+
+    def reports(self, **params):
+        return self._get('/report', params)
+
+    def summary(self, **params):
+        return self._get('/summary', params)
+
+    def query(self, **params):
+        return self._get('/query', params)
+
+    def running(self, **params):
+        return self._get('/running', params)
+
+    def failed(self, **params):
+        return self._get('/failed', params)
+
+    def close(self):
+        # send what is buffered, spooling it if the service is down
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.flusher:
+            self.flusher.join()
+        else:
+            self.flush()
+        self.session.close()
+
+
+class AsyncReportClient(object):
+    """asyncio interface to ReportClient. Writes are buffered without
+    blocking, and batches and reads run on the pooled connections in the
+    default executor, at most max_in_flight at once.
+
+        async with AsyncReportClient('http://localhost:5000') as client:
+            await client.start(test_id, report)
+    """
+
+    def __init__(self, base_url='http://localhost:5000', max_in_flight=10,
+                 flush_interval=0.5, **kwargs):
+        self.client = ReportClient(base_url, max_in_flight=max_in_flight,
+                                   flush_interval=None, **kwargs)
+        self.flush_interval = flush_interval
+        self.semaphore = None
+        self.flusher = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _call(self, function, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.client.max_in_flight)
+        async with self.semaphore:
+            return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    def _ensure_flusher(self):
+        if self.flusher is None and self.flush_interval:
+            self.flusher = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                LOG.exception('flushing reports failed')
+
+    async def _queue(self, operation):
+        self._ensure_flusher()
+        with self.client.condition:
+            self.client.buffer.append(operation)
+            full = len(self.client.buffer) >= self.client.batch_size
+        if full:
+            await self.flush()
+
+    async def start(self, test_id, report):
+        await self._queue({'op': 'start', 'id': str(test_id), 'data': report})
+
+    async def update(self, test_id, fields):
+        await self._queue({'op': 'update', 'id': str(test_id), 'data': fields})
+
+    async def patch(self, test_id, patch):
+        await self._queue({'op': 'patch', 'id': str(test_id), 'data': patch})
+
+    async def stop(self, test_id, results):
+        await self._queue({'op': 'stop', 'id': str(test_id), 'data': results})
+
+    async def delete(self, test_id):
+        await self._queue({'op': 'delete', 'id': str(test_id)})
+
+    async def flush(self):
+        return await self._call(self.client.flush)
+
+    async def report(self, test_id, **params):
+        return await self._call(lambda: self.client.report(test_id, **params))
+
+    async def summary(self, **params):
+        return await self._call(lambda: self.client.summary(**params))
+
+    async def query(self, **params):
+        return await self._call(lambda: self.client.query(**params))
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self._call(self.client.close)
@@ -0,0 +1,46 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# gunicorn settings for SERVER_MODE=production, taken from the environment
+# like LISTEN_PORT.
+#
+#    gunicorn --config gunicorn.conf.py server:app
+#
+import os
+import multiprocessing
+
+bind = '%s:%s' % (os.getenv('LISTEN_ADDRESS', '0.0.0.0'),
+                  os.getenv('LISTEN_PORT', '5000'))
+workers = int(os.getenv('WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = 'gthread'
+threads = int(os.getenv('WORKER_THREADS', '4'))
+# workers finish in-flight requests and commit queued writes for up to
+# GRACEFUL_TIMEOUT seconds after SIGTERM
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '60'))
+accesslog = os.getenv('ACCESS_LOG', None)
+
+
+def post_worker_init(worker):
+    # each worker opens the store after the fork so no connection or
+    # lock is shared between processes
+    import server
+    server.STORE.open()
+    server.start_archiver()
+
+
+def worker_exit(arbiter, worker):
+    import server
+    server.shutdown()
@@ -18,198 +18,3117 @@
 #
 
 import os
+import sys
+import atexit
+import signal
 import time
 import datetime
 import json
+import copy
+import uuid
+import math
+import re
+import bisect
+import base64
+import sqlite3
+import gzip
+import zlib
+import hashlib
+import hmac
+import cProfile
+import pstats
+import io
+import tracemalloc
+import functools
+import shutil
+import tempfile
+import threading
+import collections
+import contextlib
+import concurrent.futures
 
-from flask import Flask, request, abort
+from flask import Flask, request, abort, g, has_request_context
 from filelock import FileLock
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 REPORT_FILE = './reports.json'
 LOCK_FILE = './reports.lock'
+JOURNAL_FILE = './reports.journal'
+
+# journaled storage appends each mutation to JOURNAL_FILE and folds the
+# journal into REPORT_FILE once it outgrows the snapshot
+REPORT_JOURNAL = os.getenv('REPORT_JOURNAL', 'false').lower() in ['true', '1', 'yes']
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', '1048576'))
+
+# json keeps every report in REPORT_FILE, sqlite in REPORT_DATABASE and
+# sharded spreads them over REPORT_SHARDS files in SHARD_DIRECTORY
+REPORT_STORE = os.getenv('REPORT_STORE', 'json')
+REPORT_DATABASE = os.getenv('REPORT_DATABASE', './reports.db')
+REPORT_SHARDS = int(os.getenv('REPORT_SHARDS', '16'))
+SHARD_DIRECTORY = os.getenv('SHARD_DIRECTORY', './reports.d')
+
+# whether each write is flushed to disk before it is acknowledged
+REPORT_FSYNC = os.getenv('REPORT_FSYNC', 'true').lower() in ['true', '1', 'yes']
+
+# group commit queues writes for a single writer thread which persists
+# up to GROUP_COMMIT_BATCH of them together, waiting at most
+# GROUP_COMMIT_INTERVAL_MS for a batch to fill
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', 'false').lower() in ['true', '1', 'yes']
+GROUP_COMMIT_INTERVAL_MS = float(os.getenv('GROUP_COMMIT_INTERVAL_MS', '5'))
+GROUP_COMMIT_BATCH = int(os.getenv('GROUP_COMMIT_BATCH', '100'))
+
+# responses of at least GZIP_MIN_BYTES are compressed for clients
+# accepting gzip
+GZIP_MIN_BYTES = int(os.getenv('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+
+# lifecycle events kept for clients resuming /events or /events/poll
+EVENT_BUFFER = int(os.getenv('EVENT_BUFFER', '10000'))
+EVENT_HEARTBEAT = float(os.getenv('EVENT_HEARTBEAT', '15'))
+EVENT_POLL_TIMEOUT = float(os.getenv('EVENT_POLL_TIMEOUT', '60'))
+# streams and long polls a worker serves at once, each holds a request
+# thread, past this they are answered with 503
+EVENT_STREAMS = int(os.getenv('EVENT_STREAMS', '2'))
+
+# relative error of the duration percentiles, which bounds the number of
+# histogram bins kept per series
+SKETCH_ACCURACY = float(os.getenv('SKETCH_ACCURACY', '0.01'))
+
+# completed reports started more than RETENTION_DAYS ago, or beyond the
+# newest RETENTION_RECORDS, are moved to gzip segments in ARCHIVE_DIRECTORY
+# every ARCHIVE_INTERVAL seconds, 0 disables either limit
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_RECORDS = int(os.getenv('RETENTION_RECORDS', '0'))
+ARCHIVE_DIRECTORY = os.getenv('ARCHIVE_DIRECTORY', './reports.archive')
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '300'))
+ARCHIVE_SEGMENT_RECORDS = int(os.getenv('ARCHIVE_SEGMENT_RECORDS', '10000'))
+
+# values of the BLOB_FIELDS of a report encoding to at least BLOB_MIN_BYTES
+# are kept in BLOB_DIRECTORY, the report holding a reference to them
+BLOB_FIELDS = [name.strip() for name in
+               os.getenv('BLOB_FIELDS', 'terraform_output').split(',') if name.strip()]
+BLOB_MIN_BYTES = int(os.getenv('BLOB_MIN_BYTES', '1024'))
+BLOB_DIRECTORY = os.getenv('BLOB_DIRECTORY', './reports.blobs')
+
+# requests may ask to be profiled with X-Profile: cpu, memory or both,
+# sending ADMIN_TOKEN in X-Admin-Token, profiling is off without a token.
+# Profiles are written to PROFILE_DIRECTORY when set, else returned
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROFILE_DIRECTORY = os.getenv('PROFILE_DIRECTORY')
+
+# requests taking at least SLOW_REQUEST_SECONDS are logged with their
+# phase timings, to SLOW_REQUEST_LOG as JSON lines when it is set
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+SLOW_REQUEST_LOG = os.getenv('SLOW_REQUEST_LOG')
+
+# indexes answers /summary, /running, /failed and /query from incremental
+# aggregates and indexes, columnar from a column per field with numpy,
+# falling back to indexes when numpy is not installed
+QUERY_ENGINE = os.getenv('QUERY_ENGINE', 'indexes')
+
+# development runs the Flask server in this process, production runs
+# WORKERS gunicorn worker processes
+SERVER_MODE = os.getenv('SERVER_MODE', 'development')
+
+app = Flask(__name__)
+
+# parsed view of the store shared by all request threads, reused until
+# a local write bumps the generation or the store files change on disk
+_cache_lock = threading.Lock()
+_report_cache = {
+    'generation': 0,
+    'signature': None,
+    'reports': None,
+    'views': {}
+}
+cache_stats = {
+    'hits': 0,
+    'misses': 0
+}
+
+# digests of single reports with the report object each was made from
+_etag_lock = threading.Lock()
+_report_etags = {}
+
+# encoded GET /report bodies for the cached reports they were made from
+_encoded_lock = threading.Lock()
+_encoded_bodies = {
+    'reports': None,
+    'bodies': {}
+}
+
+
+class Histogram(object):
+    """Prometheus style histogram, counts of observations at or below each
+    bucket bound plus their sum."""
+
+    # seconds, from a cached read to a rewrite of a large store
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with _metrics_lock:
+            self.counts[index] = self.counts[index] + 1
+            self.sum = self.sum + value
+
+    def samples(self):
+        # [(le, cumulative count)], sum and count
+        with _metrics_lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative = cumulative + count
+            samples.append(('+Inf' if bound == float('inf') else repr(bound), cumulative))
+        return (samples, total, cumulative)
+
+
+# counters and histograms behind /metrics, each worker process has its own
+_metrics_lock = threading.Lock()
+request_counts = {}
+request_durations = {}
+lock_wait = Histogram()
+lock_hold = Histogram()
+json_decode = Histogram()
+json_encode = Histogram()
+response_encode = Histogram()
+event_counts = {
+    'store_load_retries': 0,
+    'journal_decode_errors': 0,
+    'response_cache_hits': 0,
+    'response_cache_misses': 0,
+    'event_streams_refused': 0
+}
+
+
+def _record_phase(phase, seconds):
+    # time spent in a phase of the current request, for the slow request
+    # log; work done outside a request, by the group commit writer, is not
+    # attributed to one
+    if has_request_context() and 'phases' in g:
+        g.phases[phase] = g.phases.get(phase, 0) + seconds
+
+
+def _count_event(name):
+    with _metrics_lock:
+        event_counts[name] = event_counts[name] + 1
+
+
+def _dump_reports(reports):
+    return json.dumps(reports, sort_keys=True,
+                      indent=4, separators=(',', ': '))
+
+
+def _merge_patch(target, patch):
+    # RFC 7386 JSON merge patch, returning a new value: objects are merged
+    # member by member, null removes a member, anything else replaces
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, dict):
+        target = dict(target)
+    else:
+        target = {}
+    for name in patch:
+        if patch[name] is None:
+            target.pop(name, None)
+        else:
+            target[name] = _merge_patch(target.get(name), patch[name])
+    return target
+
+
+def _merge_diff(old, new):
+    # the merge patch turning the object old into new, None when new holds
+    # a null member, which a merge patch can not set
+    patch = {}
+    for name in old:
+        if name not in new:
+            patch[name] = None
+    for name in new:
+        value = new[name]
+        if name in old and old[name] == value:
+            continue
+        if value is None:
+            return None
+        if isinstance(value, dict):
+            base = old.get(name)
+            value = _merge_diff(base if isinstance(base, dict) else {}, value)
+            if value is None:
+                return None
+        patch[name] = value
+    return patch
+
+
+def _replace_file(path, content):
+    # write a complete copy beside the file, make it durable and rename it
+    # into place so no reader ever sees a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_file = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as output_file:
+            output_file.write(content)
+            output_file.flush()
+            if REPORT_FSYNC:
+                os.fsync(output_file.fileno())
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, path)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+class JsonFileStore(object):
+    """Every report in one JSON document, optionally with a journal of
+    mutations appended since the document was last written.
+
+    The document is only ever replaced by renaming a complete copy over
+    it, so readers never take the lock; writers still serialize on it.
+    """
+
+    def __init__(self, report_file=REPORT_FILE, lock_file=LOCK_FILE,
+                 journal_file=JOURNAL_FILE, journal=REPORT_JOURNAL):
+        self.report_file = report_file
+        self.lock_file = lock_file
+        self.journal_file = journal_file
+        self.journal = journal
+        # a counter bumped by every write, so processes sharing the store
+        # notice writes the file times are too coarse to tell apart
+        self.generation_file = os.path.splitext(report_file)[0] + '.generation'
+
+    def lock(self, report_ids=None):
+        return FileLock(self.lock_file)
+
+    def open(self):
+        # fold any journal left behind so both modes start from a
+        # complete snapshot
+        with self.lock():
+            if os.path.exists(self.journal_file):
+                self._compact()
+
+    def signature(self, report_ids=None):
+        # inode, mtime and size of every store file, used to notice writes
+        # made by other processes
+        signature = {}
+        for name, path in [('report', self.report_file), ('journal', self.journal_file)]:
+            try:
+                stat = os.stat(path)
+                signature[name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                signature[name] = None
+        try:
+            with open(self.generation_file, 'r') as generation_file:
+                signature['generation'] = generation_file.read()
+        except OSError:
+            signature['generation'] = None
+        return signature
+
+    def _bump_generation(self):
+        # called with the store lock held
+        generation = 0
+        try:
+            with open(self.generation_file, 'r') as generation_file:
+                generation = int(generation_file.read())
+        except (OSError, ValueError):
+            pass
+        with open(self.generation_file, 'w') as generation_file:
+            generation_file.write(str(generation + 1))
+
+    def _replay_journal(self, reports):
+        started = time.perf_counter()
+        try:
+            journal_file = open(self.journal_file, 'r')
+        except FileNotFoundError:
+            # none, or folded into the snapshot by a compaction since the
+            # snapshot was read, which load notices and reads again
+            return reports
+        with journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a partial record left by an interrupted append
+                    _count_event('journal_decode_errors')
+                    continue
+                # a batch of changes is appended as one record so
+                # readers see all of it or none of it
+                for change in record.get('records', [record]):
+                    if change['op'] == 'put':
+                        reports[change['id']] = change['report']
+                    elif change['op'] == 'patch':
+                        reports[change['id']] = _merge_patch(
+                            reports.get(change['id']), change['patch'])
+                    elif change['op'] == 'delete':
+                        reports.pop(change['id'], None)
+        json_decode.observe(time.perf_counter() - started)
+        _record_phase('parse', time.perf_counter() - started)
+        return reports
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_file)
+        except OSError:
+            return 0
+
+    def _read_snapshot(self):
+        try:
+            with open(self.report_file, 'r') as reports_file:
+                reports_json = reports_file.read()
+        except FileNotFoundError:
+            return {}
+        if reports_json:
+            started = time.perf_counter()
+            reports = json.loads(reports_json)
+            json_decode.observe(time.perf_counter() - started)
+            _record_phase('parse', time.perf_counter() - started)
+            return reports
+        return {}
+
+    def _write_snapshot(self, reports):
+        started = time.perf_counter()
+        content = _dump_reports(reports).encode('utf-8')
+        json_encode.observe(time.perf_counter() - started)
+        _replace_file(self.report_file, content)
+
+    def _compact(self):
+        self._write_snapshot(self._replay_journal(self._read_snapshot()))
+        os.unlink(self.journal_file)
+
+    def _append_journal(self, records):
+        if len(records) > 1:
+            records = [{'op': 'batch', 'records': records}]
+        started = time.perf_counter()
+        line = (json.dumps(records[0], separators=(',', ':')) + '\n').encode('utf-8')
+        json_encode.observe(time.perf_counter() - started)
+        with open(self.journal_file, 'a+b') as journal_file:
+            # an append torn by a crash leaves a partial last line, which
+            # the next record must not be glued onto
+            journal_file.seek(0, os.SEEK_END)
+            if journal_file.tell() > 0:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b'\n':
+                    line = b'\n' + line
+            journal_file.write(line)
+            journal_file.flush()
+            if REPORT_FSYNC:
+                os.fsync(journal_file.fileno())
+        # fold once the journal outgrows the snapshot so the cost of
+        # compaction stays amortized against the appends that caused it
+        journal_size = self._journal_size()
+        if journal_size > JOURNAL_COMPACT_BYTES:
+            snapshot_size = 0
+            if os.path.exists(self.report_file):
+                snapshot_size = os.path.getsize(self.report_file)
+            if journal_size > snapshot_size:
+                self._compact()
+
+    def read(self, report_ids=None):
+        if self.journal:
+            return self._replay_journal(self._read_snapshot())
+        return self._read_snapshot()
+
+    def load(self, parts=None):
+        # without the lock, a compaction or clear can replace the document
+        # between reading it and the journal, so read again when it did.
+        # The signature from before the read can only be older than the
+        # reports, which makes the next read check again
+        while True:
+            signature = self.signature()
+            reports = self.read()
+            if self.signature()['report'] == signature['report']:
+                return (reports, signature)
+            _count_event('store_load_retries')
+
+    def size(self):
+        # bytes on disk
+        size = 0
+        for path in [self.report_file, self.journal_file]:
+            try:
+                size = size + os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def write(self, changes, patches=None):
+        # persist (report_id, report) changes, None deleting the report, in
+        # a single append or rewrite. patches holds, for each change, a
+        # merge patch from the stored report to the new one or None; the
+        # journal records those instead of whole reports. Called with the
+        # store lock held
+        if patches is None:
+            patches = [None] * len(changes)
+        if self.journal:
+            records = []
+            for (report_id, report), patch in zip(changes, patches):
+                if report is None:
+                    records.append({'op': 'delete', 'id': report_id})
+                elif patch is not None:
+                    records.append({'op': 'patch', 'id': report_id, 'patch': patch})
+                else:
+                    records.append({'op': 'put', 'id': report_id, 'report': report})
+            self._append_journal(records)
+        else:
+            if not os.path.exists(self.report_file) and \
+                    all(report is None for report_id, report in changes):
+                return
+            reports = self._read_snapshot()
+            for report_id, report in changes:
+                if report is None:
+                    reports.pop(report_id, None)
+                else:
+                    reports[report_id] = report
+            self._write_snapshot(reports)
+        self._bump_generation()
+
+    def clear(self):
+        # called with the store lock held
+        if os.path.exists(self.report_file):
+            os.unlink(self.report_file)
+        if os.path.exists(self.journal_file):
+            os.unlink(self.journal_file)
+        self._bump_generation()
+
+
+def _report_status(report):
+    if report.get('duration') == 0:
+        return 'running'
+    results = report.get('results') or {}
+    if 'status' in results and results['status'] == 'SUCCESS':
+        return 'success'
+    return 'failed'
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id TEXT PRIMARY KEY,
+    zone TEXT,
+    type TEXT,
+    image_name TEXT,
+    status TEXT,
+    start_time REAL,
+    duration REAL,
+    report TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_zone ON reports (zone);
+CREATE INDEX IF NOT EXISTS reports_type ON reports (type);
+CREATE INDEX IF NOT EXISTS reports_image_name ON reports (image_name);
+CREATE INDEX IF NOT EXISTS reports_status ON reports (status);
+CREATE INDEX IF NOT EXISTS reports_start_time ON reports (start_time);
+CREATE INDEX IF NOT EXISTS reports_duration ON reports (duration);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+'''
+
+
+class SqliteStore(object):
+    """One row per report in an SQLite database in WAL mode, with the
+    fields used for filtering held in indexed columns."""
+
+    def __init__(self, database=REPORT_DATABASE):
+        self.database = database
+        self.local = threading.local()
+        self.json_patch = False
+
+    def _connection(self):
+        # sqlite connections can not be shared between request threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database, timeout=60,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=%s' %
+                               ('FULL' if REPORT_FSYNC else 'NORMAL'))
+            connection.executescript(SQLITE_SCHEMA)
+            try:
+                connection.execute("SELECT json_patch('{}', '{}')")
+                self.json_patch = True
+            except sqlite3.OperationalError:
+                # built without the JSON functions
+                self.json_patch = False
+            self.local.connection = connection
+        return connection
+
+    def open(self):
+        self._connection()
+
+    @contextlib.contextmanager
+    def lock(self, report_ids=None):
+        # an immediate transaction holds the database write lock, readers
+        # keep reading the last committed state
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def signature(self, report_ids=None):
+        # bumped by every write, so other processes notice them
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return {'generation': row[0] if row else None}
+
+    def read(self, report_ids=None):
+        # only the rows of report_ids when given, so a write after another
+        # process changed the store decodes the reports it touches
+        connection = self._connection()
+        reports = {}
+        if report_ids is None:
+            rows = connection.execute('SELECT id, report FROM reports').fetchall()
+        else:
+            report_ids = list(report_ids)
+            rows = []
+            # within the smallest limit on bound parameters
+            for first in range(0, len(report_ids), 500):
+                chunk = report_ids[first:first + 500]
+                rows.extend(connection.execute(
+                    'SELECT id, report FROM reports WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk).fetchall())
+        started = time.perf_counter()
+        for report_id, report in rows:
+            reports[report_id] = json.loads(report)
+        json_decode.observe(time.perf_counter() - started)
+        _record_phase('parse', time.perf_counter() - started)
+        return reports
+
+    def load(self, parts=None):
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            return (self.read(), self.signature())
+        finally:
+            connection.execute('COMMIT')
+
+    def size(self):
+        size = 0
+        for path in [self.database, self.database + '-wal']:
+            try:
+                size = size + os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def write(self, changes, patches=None):
+        # called with the store lock held. A change with a merge patch
+        # from the stored report has json_patch apply it to the row, so
+        # only the changed fields are encoded
+        connection = self._connection()
+        if patches is None or not self.json_patch:
+            patches = [None] * len(changes)
+        encoded = []
+        started = time.perf_counter()
+        for (report_id, report), patch in zip(changes, patches):
+            if report is None:
+                encoded.append(None)
+            elif patch is not None:
+                encoded.append(json.dumps(patch))
+            else:
+                encoded.append(json.dumps(report))
+        json_encode.observe(time.perf_counter() - started)
+        for (report_id, report), patch, report_json in zip(changes, patches, encoded):
+            if report is None:
+                connection.execute('DELETE FROM reports WHERE id = ?',
+                                   (report_id,))
+            elif patch is not None:
+                connection.execute(
+                    'UPDATE reports SET zone = ?, type = ?, image_name = ?, status = ?, start_time = ?, duration = ?, '
+                    'report = json_patch(report, ?) WHERE id = ?',
+                    (report.get('zone'), report.get('type'),
+                     report.get('image_name'), _report_status(report),
+                     report.get('start_time'), report.get('duration'),
+                     report_json, report_id))
+            else:
+                connection.execute(
+                    'INSERT OR REPLACE INTO reports (id, zone, type, image_name, status, start_time, duration, report) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (report_id, report.get('zone'), report.get('type'),
+                     report.get('image_name'), _report_status(report),
+                     report.get('start_time'), report.get('duration'),
+                     report_json))
+        connection.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def clear(self):
+        # called with the store lock held
+        connection = self._connection()
+        connection.execute('DELETE FROM reports')
+        connection.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+
+class ShardedStore(object):
+    """Reports hash partitioned over JSON file stores, each with its own
+    lock, so writes to different shards proceed in parallel."""
+
+    def __init__(self, directory=SHARD_DIRECTORY, shards=REPORT_SHARDS):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shards = []
+        for index in range(shards):
+            path = os.path.join(directory, 'shard-%03d' % index)
+            self.shards.append(JsonFileStore(report_file=path + '.json',
+                                             lock_file=path + '.lock',
+                                             journal_file=path + '.journal'))
+
+    def part(self, report_id):
+        return zlib.crc32(report_id.encode('utf-8')) % len(self.shards)
+
+    def _parts(self, report_ids):
+        if report_ids is None:
+            return list(range(len(self.shards)))
+        return sorted(set(self.part(report_id) for report_id in report_ids))
+
+    def open(self):
+        layout_file = os.path.join(self.directory, 'layout.json')
+        if os.path.exists(layout_file):
+            with open(layout_file, 'r') as layout:
+                shards = json.loads(layout.read())['shards']
+            if shards != len(self.shards):
+                raise RuntimeError('%s holds %d shards, run server.py reshard %d'
+                                   % (self.directory, shards, len(self.shards)))
+        else:
+            with open(layout_file, 'w') as layout:
+                layout.write(json.dumps({'shards': len(self.shards)}))
+        for shard in self.shards:
+            shard.open()
+
+    @contextlib.contextmanager
+    def lock(self, report_ids=None):
+        # shards are locked in index order so writers can not deadlock
+        with contextlib.ExitStack() as stack:
+            for part in self._parts(report_ids):
+                stack.enter_context(self.shards[part].lock())
+            yield
+
+    def signature(self, report_ids=None):
+        signature = {}
+        for part in self._parts(report_ids):
+            signature[part] = self.shards[part].signature()
+        return signature
+
+    def read(self, report_ids=None):
+        # called with the shards of report_ids locked
+        reports = {}
+        for part in self._parts(report_ids):
+            reports.update(self.shards[part].read())
+        return reports
+
+    def load(self, parts=None):
+        if parts is None:
+            parts = list(range(len(self.shards)))
+        reports = {}
+        signature = {}
+        if not parts:
+            return (reports, signature)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(parts), 8)) as pool:
+            loaded = pool.map(lambda part: self.shards[part].load(), parts)
+            for part, (shard_reports, shard_signature) in zip(parts, loaded):
+                reports.update(shard_reports)
+                signature[part] = shard_signature
+        return (reports, signature)
+
+    def size(self):
+        return sum(shard.size() for shard in self.shards)
+
+    def write(self, changes, patches=None):
+        # called with the shards of the changed reports locked
+        if patches is None:
+            patches = [None] * len(changes)
+        shard_changes = {}
+        shard_patches = {}
+        for (report_id, report), patch in zip(changes, patches):
+            part = self.part(report_id)
+            shard_changes.setdefault(part, []).append((report_id, report))
+            shard_patches.setdefault(part, []).append(patch)
+        for part in shard_changes:
+            self.shards[part].write(shard_changes[part], shard_patches[part])
+
+    def clear(self):
+        # called with every shard locked
+        for shard in self.shards:
+            shard.clear()
+
+
+def reshard_reports(directory, shards):
+    # move every report into a new number of shards, run while the service
+    # is stopped. The new shards are written beside the old ones and only
+    # swapped in once complete, so a failure leaves the old ones in place
+    layout_file = os.path.join(directory, 'layout.json')
+    current = REPORT_SHARDS
+    if os.path.exists(layout_file):
+        with open(layout_file, 'r') as layout:
+            current = json.loads(layout.read())['shards']
+    source = ShardedStore(directory, current)
+    with source.lock():
+        reports = source.read()
+    directory = os.path.abspath(directory)
+    new_directory = directory + '.reshard'
+    old_directory = directory + '.old'
+    for path in [new_directory, old_directory]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    target = ShardedStore(new_directory, shards)
+    target.open()
+    with target.lock():
+        target.write(list(reports.items()))
+        if len(target.read()) != len(reports):
+            raise RuntimeError('resharding %s lost reports, left unchanged' % directory)
+    os.rename(directory, old_directory)
+    os.rename(new_directory, directory)
+    shutil.rmtree(old_directory)
+    return len(reports)
+
+
+REPORT_STORES = {
+    'json': JsonFileStore,
+    'sqlite': SqliteStore,
+    'sharded': ShardedStore
+}
+
+STORE = REPORT_STORES[REPORT_STORE]()
+
+
+def migrate_reports(source, target):
+    # copy every report from one store into another in a single write
+    source.open()
+    target.open()
+    with source.lock():
+        reports = source.read()
+    with target.lock():
+        target.write(list(reports.items()))
+    return len(reports)
+
+
+class ReportArchive(object):
+    """Reports moved out of the store, in gzip compressed NDJSON segments
+    that are written once. Each segment has an index file holding its
+    start_time range and sorted report ids, which is only written once the
+    segment is complete, so segments without one are ignored. Deleting an
+    archived report appends a tombstone hiding it in the segments written
+    until then, and segment numbers are never reused, so caches keyed by
+    segment name stay valid."""
+
+    def __init__(self, directory=ARCHIVE_DIRECTORY):
+        self.directory = directory
+        self.indexes = {}
+        self.deleted = (None, {})
+        self.lock = threading.Lock()
+        self.deleted_file = os.path.join(directory, 'deleted.ndjson')
+        self.sequence_file = os.path.join(directory, 'sequence.json')
+
+    def segments(self):
+        # [(name, index)] oldest first, loading indexes written since the
+        # last call, possibly by another process
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        with self.lock:
+            for name in list(self.indexes):
+                if name not in names:
+                    # removed by a clear
+                    del self.indexes[name]
+            for name in names:
+                if name.endswith('.index.json') and name not in self.indexes:
+                    with open(os.path.join(self.directory, name)) as index_file:
+                        self.indexes[name] = json.load(index_file)
+            return sorted(self.indexes.items())
+
+    def _tombstones(self):
+        # {report_id: newest segment number it was deleted from}, read
+        # again whenever the file changed
+        try:
+            stat = os.stat(self.deleted_file)
+            stamp = (stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            return {}
+        with self.lock:
+            if self.deleted[0] == stamp:
+                return self.deleted[1]
+        deleted = {}
+        with open(self.deleted_file, 'r') as deleted_file:
+            for line in deleted_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                deleted[record['id']] = max(deleted.get(record['id'], 0), record['segment'])
+        with self.lock:
+            self.deleted = (stamp, deleted)
+        return deleted
+
+    def _copies(self, report_id):
+        # the indexes of the segments holding a visible copy, newest first
+        deleted = self._tombstones().get(report_id, 0)
+        copies = []
+        for name, index in reversed(self.segments()):
+            if _segment_number(index['segment']) <= deleted:
+                break
+            ids = index['ids']
+            position = bisect.bisect_left(ids, report_id)
+            if position < len(ids) and ids[position] == report_id:
+                copies.append(index)
+        return copies
+
+    def contains(self, report_id):
+        return bool(self._copies(report_id))
+
+    def find(self, report_id):
+        # newest first, the report or None
+        for index in self._copies(report_id):
+            return self._read_segment(index['segment']).get(report_id)
+        return None
+
+    def scan(self, since=None, until=None):
+        # (report_id, report) started within [since, until), from the
+        # segments whose range overlaps it
+        deleted = self._tombstones()
+        for name, index in self.segments():
+            if since is not None and index['start_max'] < since:
+                continue
+            if until is not None and index['start_min'] >= until:
+                continue
+            number = _segment_number(index['segment'])
+            reports = self._read_segment(index['segment'])
+            for report_id, report in reports.items():
+                if deleted.get(report_id, 0) >= number:
+                    continue
+                start_time = report.get('start_time') or 0
+                if since is not None and start_time < since:
+                    continue
+                if until is not None and start_time >= until:
+                    continue
+                yield (report_id, report)
+
+    @functools.lru_cache(maxsize=4)
+    def _read_segment(self, segment):
+        # segments never change, so the few most recently read are kept
+        # decoded; the reports returned are shared and must not be modified
+        reports = {}
+        with gzip.open(os.path.join(self.directory, segment), 'rt') as segment_file:
+            for line in segment_file:
+                record = json.loads(line)
+                reports[record['id']] = record['report']
+        return reports
+
+    def _last_number(self):
+        # the number of the newest segment ever written, cleared or not
+        numbers = [_segment_number(name) for name in os.listdir(self.directory)
+                   if name.endswith('.ndjson.gz')]
+        try:
+            with open(self.sequence_file, 'r') as sequence_file:
+                numbers.append(json.load(sequence_file)['last'])
+        except FileNotFoundError:
+            pass
+        return max(numbers) if numbers else 0
+
+    def delete(self, report_id):
+        # hide the archived copies of a report, called with the store locked
+        if not self.contains(report_id):
+            return
+        line = json.dumps({'id': report_id, 'segment': self._last_number()}) + '\n'
+        with open(self.deleted_file, 'a') as deleted_file:
+            deleted_file.write(line)
+            deleted_file.flush()
+            if REPORT_FSYNC:
+                os.fsync(deleted_file.fileno())
+
+    def clear(self):
+        # remove every archived report, called with the store locked
+        if not os.path.isdir(self.directory):
+            return
+        last = self._last_number()
+        _replace_file(self.sequence_file, json.dumps({'last': last}).encode('utf-8'))
+        for name in os.listdir(self.directory):
+            if name.endswith('.ndjson.gz') or name.endswith('.index.json') or \
+                    name == os.path.basename(self.deleted_file):
+                os.unlink(os.path.join(self.directory, name))
+
+    def append(self, entries):
+        # write [(report_id, report)] as new segments of at most
+        # ARCHIVE_SEGMENT_RECORDS reports, called with the store locked
+        os.makedirs(self.directory, exist_ok=True)
+        number = self._last_number() + 1
+        for first in range(0, len(entries), ARCHIVE_SEGMENT_RECORDS):
+            chunk = entries[first:first + ARCHIVE_SEGMENT_RECORDS]
+            segment = '%08d.ndjson.gz' % number
+            lines = []
+            for report_id, report in chunk:
+                lines.append(json.dumps({'id': report_id, 'report': report},
+                                        separators=(',', ':')))
+            _replace_file(os.path.join(self.directory, segment),
+                          gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'), GZIP_LEVEL))
+            start_times = [report.get('start_time') or 0 for report_id, report in chunk]
+            index = {
+                'segment': segment,
+                'count': len(chunk),
+                'start_min': min(start_times),
+                'start_max': max(start_times),
+                'ids': sorted(report_id for report_id, report in chunk)
+            }
+            _replace_file(os.path.join(self.directory, '%08d.index.json' % number),
+                          json.dumps(index).encode('utf-8'))
+            number = number + 1
+
+
+def _segment_number(name):
+    return int(name.split('.')[0])
+
+
+ARCHIVE = ReportArchive()
+
+# the member marking a value kept in the blob store
+BLOB_KEY = '$blob'
+
+
+class BlobStore(object):
+    """Large report values kept out of the reports, one file per distinct
+    value named by the digest of its encoding. Reports hold a small
+    reference instead, so the documents every request parses stay small
+    and a value is only read when a response includes it."""
+
+    def __init__(self, directory=BLOB_DIRECTORY):
+        self.directory = directory
+        # blobs never change, so the most recently read are kept decoded
+        # per store. A missing blob raises, and is not cached
+        self._read = functools.lru_cache(maxsize=256)(self._decode)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.json')
+
+    def _decode(self, digest):
+        with open(self._path(digest), 'rb') as blob_file:
+            return json.loads(blob_file.read())
+
+    def put(self, encoded):
+        # store the encoded value, returning the reference to it. Called
+        # with the store locked so prune never sees a blob being written
+        digest = hashlib.sha1(encoded).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            _replace_file(path, encoded)
+        return {BLOB_KEY: digest, 'bytes': len(encoded)}
+
+    def get(self, digest):
+        # the value returned is shared and must not be modified. None when
+        # the blob was pruned after the report referring to it was read,
+        # or is yet to be seen by this worker
+        try:
+            return self._read(digest)
+        except FileNotFoundError:
+            return None
+
+    def prune(self, referenced):
+        # remove the blobs whose digest is not in referenced, returning how
+        # many, called with every part of the store locked
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for name in names:
+            if name.endswith('.json') and name[:-5] not in referenced:
+                os.unlink(os.path.join(self.directory, name))
+                removed = removed + 1
+        return removed
+
+
+BLOBS = BlobStore()
+
+
+def _is_blob(value):
+    return isinstance(value, dict) and BLOB_KEY in value
+
+
+def _store_blobs(report):
+    # the report with its large BLOB_FIELDS values moved to the blob store
+    if report is None:
+        return None
+    stored = report
+    for name in BLOB_FIELDS:
+        value = report.get(name)
+        if value is None or _is_blob(value):
+            continue
+        encoded = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(encoded) >= BLOB_MIN_BYTES:
+            if stored is report:
+                stored = dict(report)
+            stored[name] = BLOBS.put(encoded)
+    return stored
+
+
+def _load_blobs(report, names=None):
+    # the report with the blobs among its fields, or the names given,
+    # read back in; the report itself when it refers to none
+    loaded = report
+    for name in report if names is None else names:
+        if _is_blob(report.get(name)):
+            if loaded is report:
+                loaded = dict(report)
+            loaded[name] = BLOBS.get(report[name][BLOB_KEY])
+    return loaded
+
+
+def _blob_references(reports):
+    referenced = set()
+    for report_id in reports:
+        for value in reports[report_id].values():
+            if _is_blob(value):
+                referenced.add(value[BLOB_KEY])
+    return referenced
+
+
+class EventFeed(object):
+    """Bounded ring buffer of report lifecycle events, numbered so clients
+    can resume after reconnecting."""
+
+    def __init__(self, size=EVENT_BUFFER):
+        self.events = collections.deque(maxlen=size)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        # sequence numbers only mean something to the process numbering
+        # them, so event ids carry the process and when it started
+        self.epoch = '%d:%d' % (os.getpid(), time.time() * 1000)
+
+    def event_id(self, sequence):
+        return '%s:%d' % (self.epoch, sequence)
+
+    def parse_id(self, event_id):
+        # the sequence number of an event id from this process, None for
+        # one from another process or an earlier run
+        epoch, _, sequence = event_id.rpartition(':')
+        if epoch != self.epoch:
+            return None
+        try:
+            return int(sequence)
+        except ValueError:
+            return None
+
+    def publish(self, changes):
+        # changes is a list of (report_id, old_report, report) with None
+        # for a report that did not or no longer exists, report_id None
+        # when every report was deleted
+        now = time.time()
+        with self.condition:
+            for report_id, old_report, report in changes:
+                if report_id is None:
+                    event = 'cleared'
+                elif report is None:
+                    if old_report is None:
+                        continue
+                    event = 'deleted'
+                elif old_report is None:
+                    event = 'started'
+                elif old_report.get('duration') == 0 and report.get('duration') != 0:
+                    event = 'stopped'
+                else:
+                    event = 'updated'
+                latest = report if report is not None else old_report or {}
+                self.sequence = self.sequence + 1
+                self.events.append({
+                    'seq': self.sequence,
+                    'event': event,
+                    'id': report_id,
+                    'time': now,
+                    'zone': latest.get('zone'),
+                    'type': latest.get('type'),
+                    'image_name': latest.get('image_name'),
+                    'duration': latest.get('duration'),
+                    'status': (latest.get('results') or {}).get('status')
+                })
+            self.condition.notify_all()
+
+    def since(self, sequence):
+        # events after sequence and whether some were already dropped
+        with self.condition:
+            if sequence > self.sequence:
+                # numbered by another worker or before a restart
+                return (list(self.events), True)
+            missed = bool(self.events) and self.events[0]['seq'] > sequence + 1
+            events = [event for event in self.events if event['seq'] > sequence]
+            return (events, missed)
+
+    def wait(self, sequence, timeout):
+        with self.condition:
+            if self.sequence <= sequence:
+                self.condition.wait(timeout)
+        return self.since(sequence)
+
+
+FEED = EventFeed()
+
+
+def _diff_reports(old_reports, reports):
+    changes = []
+    for report_id in old_reports:
+        if report_id not in reports:
+            changes.append((report_id, old_reports[report_id], None))
+    for report_id in reports:
+        old_report = old_reports.get(report_id)
+        if old_report != reports[report_id]:
+            changes.append((report_id, old_report, reports[report_id]))
+    return changes
+
+
+@contextlib.contextmanager
+def _timed_lock(report_ids=None):
+    # the store lock, timing the wait for it and how long it is held
+    started = time.perf_counter()
+    with STORE.lock(report_ids):
+        acquired = time.perf_counter()
+        lock_wait.observe(acquired - started)
+        _record_phase('lock_wait', acquired - started)
+        try:
+            yield
+        finally:
+            lock_hold.observe(time.perf_counter() - acquired)
+            _record_phase('lock_hold', time.perf_counter() - acquired)
+
+
+def _cache_current(signature):
+    # whether the cached reports match every part of the store in
+    # signature, called with _cache_lock held
+    cached_signature = _report_cache['signature']
+    if _report_cache['reports'] is None or cached_signature is None:
+        return False
+    for part in signature:
+        if part not in cached_signature or cached_signature[part] != signature[part]:
+            return False
+    return True
+
+
+def _update_cache(signature_before, signature_after, changes, clear=False):
+    # apply a local write to the cached reports when the cache was current
+    # for the parts of the store written, otherwise drop it so the next
+    # read reloads. changes is a list of (report_id, report) with None for
+    # a delete
+    with _cache_lock:
+        _report_cache['generation'] = _report_cache['generation'] + 1
+        if _cache_current(signature_before):
+            # copy on write so readers iterating the old dict are unaffected
+            if clear:
+                old_reports = {}
+                reports = {}
+                _report_cache['views'] = {}
+            else:
+                old_reports = _report_cache['reports']
+                reports = dict(old_reports)
+            for report_id, report in changes:
+                old_report = reports.pop(report_id, None)
+                if report is not None:
+                    reports[report_id] = report
+                _update_views(report_id, old_report, report)
+            signature = dict(_report_cache['signature'])
+            signature.update(signature_after)
+            _report_cache['reports'] = reports
+            _report_cache['signature'] = signature
+        else:
+            _report_cache['reports'] = None
+            _report_cache['signature'] = None
+            _report_cache['views'] = {}
+
+
+def _update_views(report_id, old_report, report):
+    # called with _cache_lock held, a view that fails to update is
+    # dropped and rebuilt from the reports the next time it is needed
+    views = _report_cache['views']
+    for name in list(views):
+        try:
+            if old_report is not None:
+                views[name].remove(report_id, old_report)
+            if report is not None:
+                views[name].add(report_id, report)
+        except Exception:
+            del views[name]
+
+
+def read_view(name, reader):
+    # views are updated in place, so reader runs with _cache_lock held and
+    # is passed the reports the view currently reflects
+    while True:
+        reports = read_reports()
+        with _cache_lock:
+            if _report_cache['reports'] is not reports:
+                # replaced by a write since it was read, try again
+                continue
+            views = _report_cache['views']
+            if name not in views:
+                views[name] = _build_view(name, reports)
+            return reader(views[name], reports)
+
+
+def _build_view(name, reports):
+    view = REPORT_VIEWS[name]()
+    if hasattr(view, 'extend'):
+        view.extend(reports)
+        return view
+    for report_id in reports:
+        try:
+            view.add(report_id, reports[report_id])
+        except Exception:
+            # a malformed report is left out of the view rather than
+            # failing every request using it
+            app.logger.exception('report %s left out of the %s view',
+                                 report_id, name)
+    return view
+
+
+def read_reports():
+    # the returned dict is shared between requests and must not be
+    # modified, use read_report for a private copy of one report
+    signature = STORE.signature()
+    with _cache_lock:
+        if _report_cache['reports'] is not None and \
+                _report_cache['signature'] == signature:
+            cache_stats['hits'] = cache_stats['hits'] + 1
+            return _report_cache['reports']
+        cache_stats['misses'] = cache_stats['misses'] + 1
+        cached = _report_cache['reports']
+        cached_signature = _report_cache['signature']
+    if cached is not None and hasattr(STORE, 'part'):
+        # reload only the parts of a partitioned store that changed and
+        # apply the differences like a local write
+        changed = [part for part in signature
+                   if cached_signature.get(part) != signature[part]]
+        started = time.perf_counter()
+        loaded, loaded_signature = STORE.load(changed)
+        _record_phase('load', time.perf_counter() - started)
+        old_reports = {}
+        for report_id in cached:
+            if STORE.part(report_id) in changed:
+                old_reports[report_id] = cached[report_id]
+        events = _diff_reports(old_reports, loaded)
+        before = {}
+        for part in changed:
+            before[part] = cached_signature.get(part)
+        _update_cache(before, loaded_signature,
+                      [(report_id, report) for report_id, old_report, report in events])
+        # changes written by other processes
+        FEED.publish(events)
+        return read_reports()
+    started = time.perf_counter()
+    reports, signature = STORE.load()
+    _record_phase('load', time.perf_counter() - started)
+    if cached is not None:
+        # changes written by other processes
+        FEED.publish(_diff_reports(cached, reports))
+    with _cache_lock:
+        if _report_cache['signature'] != signature:
+            _report_cache['generation'] = _report_cache['generation'] + 1
+        _report_cache['reports'] = reports
+        _report_cache['signature'] = signature
+        _report_cache['views'] = {}
+    return reports
+
+
+def read_report(report_id):
+    reports = read_reports()
+    if report_id in reports:
+        return copy.deepcopy(reports[report_id])
+    return None
+
+
+class _Operation(object):
+    """A write waiting to be committed."""
+
+    def __init__(self, update, report_ids):
+        self.update = update
+        self.report_ids = report_ids
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.changes = None
+        self.error = None
+
+
+def _commit(operations):
+    # run each operation's update against the reports left by the ones
+    # before it and persist all of their changes with one lock acquisition
+    # and one write. Stores split into parts only lock and read the parts
+    # holding the operations' report_ids, None meaning all of them
+    report_ids = set()
+    for operation in operations:
+        if operation.report_ids is None:
+            report_ids = None
+            break
+        report_ids.update(operation.report_ids)
+    if report_ids is not None:
+        report_ids = sorted(report_ids)
+    try:
+        with _timed_lock(report_ids):
+            signature_before = STORE.signature(report_ids)
+            with _cache_lock:
+                reports = _report_cache['reports']
+                if not _cache_current(signature_before):
+                    reports = None
+            if reports is None:
+                reports = STORE.read(report_ids)
+            pending = {}
+            changes = []
+            patches = []
+            events = []
+            for operation in operations:
+                try:
+                    operation.changes = [
+                        (report_id, _store_blobs(report)) for report_id, report in
+                        operation.update(_Overlay(reports, pending) if pending else reports)]
+                except Exception as ex:
+                    operation.error = ex
+                    continue
+                for report_id, report in operation.changes:
+                    if report_id in pending:
+                        old_report = pending[report_id]
+                    else:
+                        old_report = reports.get(report_id)
+                    events.append((report_id, old_report, report))
+                    pending[report_id] = report
+                    # stores able to apply a patch write only what changed
+                    patch = None
+                    if old_report is not None and report is not None:
+                        patch = _merge_diff(old_report, report)
+                    patches.append(patch)
+                changes.extend(operation.changes)
+            if changes:
+                STORE.write(changes, patches)
+                _update_cache(signature_before,
+                              STORE.signature(report_ids), changes)
+                FEED.publish(events)
+    except Exception as ex:
+        for operation in operations:
+            operation.error = ex
+    for operation in operations:
+        operation.done.set()
+
+
+class GroupCommitWriter(object):
+    """Single writer thread committing queued writes in batches."""
+
+    def __init__(self, interval_ms=GROUP_COMMIT_INTERVAL_MS,
+                 batch_size=GROUP_COMMIT_BATCH):
+        self.interval = interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.stats = {
+            'commits': 0,
+            'operations': 0,
+            'batch_sizes': {},
+            'commit_seconds': 0.0,
+            'commit_seconds_max': 0.0,
+            'latency_seconds': 0.0,
+            'latency_seconds_max': 0.0
+        }
+
+    def submit(self, update, report_ids=None):
+        # returns once the write is durable, raising what the update or
+        # the store raised
+        operation = _Operation(update, report_ids)
+        with self.condition:
+            if self.stopping:
+                # drained for shutdown, commit on the calling thread
+                operation = None
+            else:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run,
+                                                   name='group-commit',
+                                                   daemon=True)
+                    self.thread.start()
+                self.queue.append(operation)
+                # wake the writer for the first write of a batch and once
+                # the batch is full
+                if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                    self.condition.notify()
+        if operation is None:
+            operation = _Operation(update, report_ids)
+            _commit([operation])
+        operation.done.wait()
+        if operation.error:
+            raise operation.error
+        return operation.changes
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                # give concurrent requests the interval to join the batch
+                deadline = self.queue[0].queued + self.interval
+                while len(self.queue) < self.batch_size and not self.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+            started = time.monotonic()
+            _commit(batch)
+            finished = time.monotonic()
+            with self.condition:
+                self._record(batch, started, finished)
+
+    def _record(self, batch, started, finished):
+        # called with the condition held
+        stats = self.stats
+        stats['commits'] = stats['commits'] + 1
+        stats['operations'] = stats['operations'] + len(batch)
+        # batch sizes are counted in power of two buckets
+        bucket = 1
+        while bucket < len(batch):
+            bucket = bucket * 2
+        stats['batch_sizes'][bucket] = stats['batch_sizes'].get(bucket, 0) + 1
+        stats['commit_seconds'] = stats['commit_seconds'] + finished - started
+        stats['commit_seconds_max'] = max(stats['commit_seconds_max'], finished - started)
+        for operation in batch:
+            latency = finished - operation.queued
+            stats['latency_seconds'] = stats['latency_seconds'] + latency
+            stats['latency_seconds_max'] = max(stats['latency_seconds_max'], latency)
+
+    def stop(self):
+        # commit everything queued and stop the writer thread
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+WRITER = GroupCommitWriter() if GROUP_COMMIT else None
+
+
+def shutdown():
+    # commit any queued writes before the process exits
+    _archiver_stop.set()
+    if WRITER is not None:
+        WRITER.stop()
+
+
+atexit.register(shutdown)
+
+
+def update_reports(update, report_ids=None):
+    # run update(reports), which returns a list of changes, and persist
+    # them, through the group commit writer when it is enabled
+    if WRITER is not None:
+        return WRITER.submit(update, report_ids)
+    operation = _Operation(update, report_ids)
+    _commit([operation])
+    if operation.error:
+        raise operation.error
+    return operation.changes
+
+
+def add_report(report_id, report):
+    update_reports(lambda reports: [(report_id, report)], [report_id])
+
+
+def delete_report(report_id):
+    def update(reports):
+        ARCHIVE.delete(report_id)
+        return [(report_id, None)]
+    update_reports(update, [report_id])
+
+
+def delete_reports():
+    with _timed_lock():
+        signature_before = STORE.signature()
+        STORE.clear()
+        ARCHIVE.clear()
+        BLOBS.prune(set())
+        _update_cache(signature_before, STORE.signature(), [], clear=True)
+        FEED.publish([(None, None, None)])
+
+
+def _expired_reports(reports, now):
+    # ids of the completed reports the retention policy moves out, oldest
+    # first
+    completed = []
+    for report_id in reports:
+        report = reports[report_id]
+        if report.get('duration', 0) != 0:
+            completed.append(_order_key(report_id, report))
+    completed.sort()
+    expired = 0
+    if RETENTION_DAYS:
+        expired = bisect.bisect_left(completed, (now - RETENTION_DAYS * 86400,))
+    if RETENTION_RECORDS:
+        total = sum(1 for report_id in reports)
+        expired = max(expired, min(len(completed), total - RETENTION_RECORDS))
+    return [report_id for start_time, report_id in completed[:expired]]
+
+
+def archive_reports(now=None):
+    # move expired reports to the archive, returning how many were moved
+    if not RETENTION_DAYS and not RETENTION_RECORDS:
+        return 0
+    if now is None:
+        now = time.time()
+    if not _expired_reports(read_reports(), now):
+        # checked without the lock first as most runs find nothing
+        return 0
+
+    def update(reports):
+        expired = _expired_reports(reports, now)
+        # a report already archived by a run that failed to delete it
+        # from the store is not archived twice
+        ARCHIVE.append([(report_id, _load_blobs(reports[report_id])) for report_id in expired
+                        if not ARCHIVE.contains(report_id)])
+        return [(report_id, None) for report_id in expired]
+    archived = len(update_reports(update))
+    # the archive holds its own copy of the blobs of the reports moved
+    prune_blobs()
+    return archived
+
+
+def prune_blobs():
+    # remove the blobs no report in the store refers to any more, left by
+    # reports deleted, archived or given a new value. Returns how many
+    with _timed_lock():
+        return BLOBS.prune(_blob_references(STORE.read()))
+
+
+_archiver_stop = threading.Event()
+
+
+def start_archiver():
+    # apply the retention policy every ARCHIVE_INTERVAL seconds in the
+    # background; every worker runs one, the store lock keeps them apart
+    if not RETENTION_DAYS and not RETENTION_RECORDS or ARCHIVE_INTERVAL <= 0:
+        return
+
+    def run():
+        while not _archiver_stop.wait(ARCHIVE_INTERVAL):
+            try:
+                archive_reports()
+            except Exception:
+                app.logger.exception('archiving reports failed')
+    threading.Thread(target=run, name='archiver', daemon=True).start()
+
+
+class _Overlay(object):
+    """Reports with pending batch changes laid over them, None if deleted."""
+
+    def __init__(self, reports, pending):
+        self.reports = reports
+        self.pending = pending
+
+    def __contains__(self, report_id):
+        return report_id in self.pending or report_id in self.reports
+
+    def __getitem__(self, report_id):
+        if report_id in self.pending:
+            return self.pending[report_id]
+        return self.reports[report_id]
+
+    def __iter__(self):
+        for report_id in self.reports:
+            if report_id not in self.pending:
+                yield report_id
+        for report_id, report in self.pending.items():
+            if report is not None:
+                yield report_id
+
+
+class SummaryAggregates(object):
+    """Counters behind /summary, updated as reports are added and removed."""
+
+    DIMENSIONS = ['zone', 'type', 'image_name']
+
+    def __init__(self):
+        self.counters = {}
+        self.dimensions = {}
+        for dimension in self.DIMENSIONS:
+            self.dimensions[dimension] = {}
+        self.running = {}
+        self.success_durations = []
+        self.failed_durations = []
+
+    def add(self, report_id, report):
+        self._apply(report_id, report, 1)
+
+    def remove(self, report_id, report):
+        self._apply(report_id, report, -1)
+
+    def _count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _apply(self, report_id, report, sign):
+        # mirrors the per report accounting of scan_summary. Everything is
+        # read before anything is counted, so a report that can not be
+        # counted leaves the aggregates as they were
+        duration = report.get('duration')
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)):
+            raise ValueError('report %s has no numeric duration' % report_id)
+        results = report.get('results') or {}
+        counts = []
+        for phase, completed, seconds in [
+                ('workspace_create', 'workspace_create_completed', 'workspace_create_completed_seconds'),
+                ('terraform_plan', 'terraform_plan_completed', 'terraform_plan_seconds'),
+                ('terraform_apply', 'terraform_apply_completed', 'terraform_apply_seconds')]:
+            code = report.get(phase + '_result_code')
+            if code == 0:
+                counts.append((completed, 1))
+                counts.append((seconds, report.get(phase + '_duration', 0)))
+            if code == 1:
+                counts.append((phase + '_failed', 1))
+        if 'terraform_destroy_result_code' in report:
+            # counted by the apply result, as scan_summary does
+            if report.get('terraform_apply_result_code') == 0:
+                counts.append(('terraform_destroy_completed', 1))
+                counts.append(('terraform_destroy_seconds', report.get('terraform_destroy_duration', 0)))
+            if report.get('terraform_apply_result_code') == 1:
+                counts.append(('terraform_destroy_failed', 1))
+        if report.get('terraform_result_code') == 0:
+            counts.append(('terraform_completed', 1))
+            counts.append(('terraform_completed_seconds',
+                           report.get('terraform_apply_stop', 0) - (report.get('start_time') or 0)))
+        terraform_failed = False
+        if duration == 0:
+            state = 'running'
+        else:
+            duration = float(duration)
+            if results.get('status') == 'SUCCESS':
+                state = 'success'
+                durations = self.success_durations
+            else:
+                state = 'failed'
+                durations = self.failed_durations
+                terraform_code = report.get('terraform_result_code')
+                terraform_failed = isinstance(terraform_code, (int, float)) and terraform_code > 0
+                if terraform_failed:
+                    counts.append(('failed_in_terraform', 1))
+                if 'test timedout' in results:
+                    counts.append(('failed_by_timeout', 1))
+            counts.append((state + '_durations', duration))
+        keys = [(dimension, report.get(dimension)) for dimension in self.dimensions]
+
+        for name, value in counts:
+            self._count(name, sign * value)
+        if state == 'running':
+            if sign > 0:
+                self.running[report_id] = report
+            else:
+                del self.running[report_id]
+        elif sign > 0:
+            # kept sorted so min and max survive removals
+            bisect.insort(durations, duration)
+        else:
+            del durations[bisect.bisect_left(durations, duration)]
+        self._count('total', sign)
+
+        for dimension, key in keys:
+            stats = self.dimensions[dimension]
+            if key not in stats:
+                stats[key] = {
+                    'reports': 0,
+                    'running': 0,
+                    'success': 0,
+                    'failed': 0,
+                    'terraform_failed': 0
+                }
+            stats[key]['reports'] = stats[key]['reports'] + sign
+            stats[key][state] = stats[key][state] + sign
+            if state == 'failed' and terraform_failed:
+                stats[key]['terraform_failed'] = stats[key]['terraform_failed'] + sign
+            if stats[key]['reports'] == 0:
+                del stats[key]
+
+    def summary(self):
+        counters = self.counters
+
+        def average(total, count):
+            if counters.get(count, 0) > 0:
+                return round(counters.get(total, 0) / counters[count], 2)
+            return 0
+
+        def breakdown(dimension):
+            stats = {}
+            for key, counts in self.dimensions[dimension].items():
+                complete = counts['success'] + counts['failed']
+                percent_failure = 0
+                if complete > 0:
+                    percent_failure = round(
+                        (counts['failed'] / complete) * 100, 2)
+                stats[key] = {
+                    'running': counts['running'],
+                    'success': counts['success'],
+                    'failed': counts['failed'],
+                    'terraform_failed': counts['terraform_failed'],
+                    'percent_failure': percent_failure
+                }
+            return stats
+
+        now = datetime.datetime.utcnow()
+        running_reports = []
+        for report_id in sorted(self.running):
+            report = self.running[report_id]
+            duration = int(now.timestamp() - (report.get('start_time') or now.timestamp()))
+            running_reports.append("%s - %s seconds - %s - %s" % (report_id, str(
+                duration), report.get('type'), report.get('zone')))
+        num_success = len(self.success_durations)
+        num_failed = len(self.failed_durations)
+        success_avg_duration = 0
+        if num_success > 0:
+            success_avg_duration = round(
+                counters.get('success_durations', 0) / num_success, 2)
+        failed_avg_duration = 0
+        if num_failed > 0:
+            failed_avg_duration = round(
+                counters.get('failed_durations', 0) / num_failed, 2)
+        return {
+            'total_tests': counters.get('total', 0),
+            'running_tests': running_reports,
+            'success_tests': num_success,
+            'success_avg_duration': success_avg_duration,
+            'success_duration_min': round(self.success_durations[0], 2) if num_success else 0,
+            'success_duration_max': round(self.success_durations[-1], 2) if num_success else 0,
+            'failed_tests': num_failed,
+            'failed_avg_duration': failed_avg_duration,
+            'failed_duration_min': round(self.failed_durations[0], 2) if num_failed else 0,
+            'failed_duration_max': round(self.failed_durations[-1], 2) if num_failed else 0,
+            'failed_in_terraform': counters.get('failed_in_terraform', 0),
+            'failed_by_timeout': counters.get('failed_by_timeout', 0),
+            'terraform_completed': counters.get('terraform_completed', 0),
+            'terraform_completed_avg': average('terraform_completed_seconds', 'terraform_completed'),
+            'workspace_create_completed': counters.get('workspace_create_completed', 0),
+            'workspace_create_completed_avg': average('workspace_create_completed_seconds', 'workspace_create_completed'),
+            'workspace_create_failed': counters.get('workspace_create_failed', 0),
+            'terraform_plan_completed': counters.get('terraform_plan_completed', 0),
+            'terraform_plan_completed_avg': average('terraform_plan_seconds', 'terraform_plan_completed'),
+            'terraform_plan_failed': counters.get('terraform_plan_failed', 0),
+            'terraform_apply_completed': counters.get('terraform_apply_completed', 0),
+            'terraform_apply_completed_avg': average('terraform_apply_seconds', 'terraform_apply_completed'),
+            'terraform_apply_failed': counters.get('terraform_apply_failed', 0),
+            'terraform_destroy_completed': counters.get('terraform_destroy_completed', 0),
+            'terraform_destroy_completed_avg': average('terraform_destroy_seconds', 'terraform_destroy_completed'),
+            'terraform_destroy_failed': counters.get('terraform_destroy_failed', 0),
+            'zones_summary': breakdown('zone'),
+            'test_types': breakdown('type'),
+            'image_names': breakdown('image_name')
+        }
+
+
+# rollup granularities in seconds, coarsest first
+ROLLUP_BUCKETS = collections.OrderedDict([
+    ('day', 86400),
+    ('hour', 3600),
+    ('minute', 60)
+])
+
+ROLLUP_PHASES = ['workspace_create', 'terraform_plan', 'terraform_apply',
+                 'terraform_destroy']
+
+
+class SummaryRollups(object):
+    """Counters of completed reports in minute, hour and day buckets keyed by
+    start_time, merged to summarise a time range without a scan."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.starts = {}
+        for name in ROLLUP_BUCKETS:
+            self.buckets[name] = {}
+            self.starts[name] = []
+
+    def add(self, report_id, report):
+        self._apply(report, 1)
+
+    def remove(self, report_id, report):
+        self._apply(report, -1)
+
+    def _apply(self, report, sign):
+        # running reports are counted once they stop
+        if report.get('duration', 0) == 0 or 'start_time' not in report:
+            return
+        counts = {'reports': 1}
+        if (report.get('results') or {}).get('status') == 'SUCCESS':
+            state = 'success'
+        else:
+            state = 'failed'
+        counts[state] = 1
+        counts[state + '_seconds'] = float(report['duration'])
+        terraform_failed = state == 'failed' and \
+            report.get('terraform_result_code', 0) > 0
+        if terraform_failed:
+            counts['terraform_failed'] = 1
+        for phase in ROLLUP_PHASES:
+            result_code = report.get(phase + '_result_code')
+            if result_code == 0:
+                counts[phase + '_completed'] = 1
+                counts[phase + '_seconds'] = float(report.get(phase + '_duration', 0))
+            elif result_code == 1:
+                counts[phase + '_failed'] = 1
+        if report.get('terraform_result_code') == 0:
+            counts['terraform_completed'] = 1
+            counts['terraform_seconds'] = report.get('terraform_apply_stop', report['start_time']) - report['start_time']
+        for dimension in SummaryAggregates.DIMENSIONS:
+            key = report.get(dimension)
+            counts[(dimension, key, state)] = 1
+            if terraform_failed:
+                counts[(dimension, key, 'terraform_failed')] = 1
+
+        for name, width in ROLLUP_BUCKETS.items():
+            start = int(report['start_time'] // width * width)
+            buckets = self.buckets[name]
+            if start not in buckets:
+                buckets[start] = {}
+                bisect.insort(self.starts[name], start)
+            bucket = buckets[start]
+            for key, value in counts.items():
+                total = bucket.get(key, 0) + sign * value
+                if total:
+                    bucket[key] = total
+                else:
+                    bucket.pop(key, None)
+            if not bucket.get('reports'):
+                del buckets[start]
+                starts = self.starts[name]
+                del starts[bisect.bisect_left(starts, start)]
+
+    def _merge(self, name, since, until, merged):
+        starts = self.starts[name]
+        buckets = self.buckets[name]
+        first = bisect.bisect_left(starts, since)
+        last = bisect.bisect_left(starts, until)
+        for start in starts[first:last]:
+            for key, value in buckets[start].items():
+                merged[key] = merged.get(key, 0) + value
+
+    def _cover(self, since, until, merged, names):
+        # the widest buckets that fit inside the range, then narrower ones
+        # for what is left at either end
+        name = names[0]
+        if len(names) == 1:
+            self._merge(name, since, until, merged)
+            return
+        width = ROLLUP_BUCKETS[name]
+        first = -(-since // width) * width
+        last = until // width * width
+        if first < last:
+            self._merge(name, first, last, merged)
+            self._cover(since, first, merged, names[1:])
+            self._cover(last, until, merged, names[1:])
+        else:
+            self._cover(since, until, merged, names[1:])
+
+    def summary(self, since, until, bucket=None):
+        # since and until are rounded down to the minute
+        minute = ROLLUP_BUCKETS['minute']
+        since = int(since // minute * minute)
+        if until is None:
+            starts = self.starts['minute']
+            until = starts[-1] + minute if starts else since
+        until = max(since, int(until // minute * minute))
+        merged = {}
+        self._cover(since, until, merged, list(ROLLUP_BUCKETS))
+        result = {
+            'since': since,
+            'until': until,
+            'summary': _rollup_summary(merged)
+        }
+        if bucket is not None:
+            width = ROLLUP_BUCKETS[bucket]
+            starts = self.starts[bucket]
+            buckets = []
+            first = bisect.bisect_left(starts, since // width * width)
+            last = bisect.bisect_left(starts, until)
+            for start in starts[first:last]:
+                buckets.append({
+                    'start': start,
+                    'summary': _rollup_summary(self.buckets[bucket][start])
+                })
+            result['bucket'] = bucket
+            result['buckets'] = buckets
+        return result
+
+
+def _rollup_summary(counts):
+    def average(total, count):
+        if counts.get(count, 0) > 0:
+            return round(counts.get(total, 0) / counts[count], 2)
+        return 0
+
+    def breakdown(dimension):
+        stats = {}
+        for key in counts:
+            if isinstance(key, tuple) and key[0] == dimension and key[1] not in stats:
+                success = counts.get((dimension, key[1], 'success'), 0)
+                failed = counts.get((dimension, key[1], 'failed'), 0)
+                percent_failure = 0
+                if success + failed > 0:
+                    percent_failure = round((failed / (success + failed)) * 100, 2)
+                stats[key[1]] = {
+                    'success': success,
+                    'failed': failed,
+                    'terraform_failed': counts.get((dimension, key[1], 'terraform_failed'), 0),
+                    'percent_failure': percent_failure
+                }
+        return stats
+
+    summary = {
+        'completed_tests': counts.get('reports', 0),
+        'success_tests': counts.get('success', 0),
+        'success_avg_duration': average('success_seconds', 'success'),
+        'failed_tests': counts.get('failed', 0),
+        'failed_avg_duration': average('failed_seconds', 'failed'),
+        'failed_in_terraform': counts.get('terraform_failed', 0),
+        'terraform_completed': counts.get('terraform_completed', 0),
+        'terraform_completed_seconds': round(counts.get('terraform_seconds', 0), 2),
+        'terraform_completed_avg': average('terraform_seconds', 'terraform_completed')
+    }
+    for phase in ROLLUP_PHASES:
+        summary[phase + '_completed'] = counts.get(phase + '_completed', 0)
+        summary[phase + '_completed_seconds'] = round(counts.get(phase + '_seconds', 0), 2)
+        summary[phase + '_completed_avg'] = average(phase + '_seconds', phase + '_completed')
+        summary[phase + '_failed'] = counts.get(phase + '_failed', 0)
+    summary['zones_summary'] = breakdown('zone')
+    summary['test_types'] = breakdown('type')
+    summary['image_names'] = breakdown('image_name')
+    return summary
+
+
+class DurationSketch(object):
+    """Histogram of durations in logarithmic bins, each covering values
+    within SKETCH_ACCURACY of one another. Sketches merge by adding bins,
+    support removal and never hold more than a fixed number of bins."""
+
+    # durations are clamped to this range, which with the default
+    # accuracy is under 1300 bins
+    MINIMUM = 0.001
+    MAXIMUM = 10000000.0
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.count = 0
+
+    def _bin(self, value):
+        value = min(max(value, self.MINIMUM), self.MAXIMUM)
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value, sign=1):
+        index = self._bin(value)
+        count = self.bins.get(index, 0) + sign
+        if count:
+            self.bins[index] = count
+        else:
+            del self.bins[index]
+        self.count = self.count + sign
+
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count = self.count + other.count
+
+    def quantiles(self, quantiles):
+        # values at the given quantiles, each within the accuracy of the
+        # exact answer
+        values = []
+        if not self.count:
+            return [0 for quantile in quantiles]
+        indexes = sorted(self.bins)
+        for quantile in quantiles:
+            rank = quantile * (self.count - 1)
+            seen = 0
+            for index in indexes:
+                seen = seen + self.bins[index]
+                if seen > rank:
+                    break
+            values.append(round(2 * self.gamma ** index / (self.gamma + 1), 2))
+        return values
+
+
+SKETCH_PHASES = ['workspace_create', 'terraform_plan', 'terraform_apply',
+                 'terraform_destroy']
+
+
+class DurationSketches(object):
+    """Duration sketches for completed tests and for each terraform phase,
+    overall and broken down by zone, type and image."""
+
+    def __init__(self):
+        self.series = {}
+
+    def add(self, report_id, report):
+        self._apply(report, 1)
 
-app = Flask(__name__)
+    def remove(self, report_id, report):
+        self._apply(report, -1)
 
+    def _apply(self, report, sign):
+        durations = []
+        if report.get('duration', 0) != 0:
+            durations.append(('duration', float(report['duration'])))
+        for phase in SKETCH_PHASES:
+            if report.get(phase + '_result_code') == 0:
+                durations.append((phase, float(report.get(phase + '_duration', 0))))
+        if report.get('terraform_result_code') == 0 and 'start_time' in report:
+            durations.append(('terraform', report.get('terraform_apply_stop', report['start_time']) - report['start_time']))
+        # collect every key before touching a sketch so a report that cannot
+        # be read leaves the sketches as they were
+        updates = []
+        for metric, value in durations:
+            updates.append(((metric, None, None), value))
+            for dimension in SummaryAggregates.DIMENSIONS:
+                updates.append(((metric, dimension, report.get(dimension)), value))
+        for key, value in updates:
+            if key not in self.series:
+                self.series[key] = DurationSketch()
+            sketch = self.series[key]
+            sketch.add(value, sign)
+            if not sketch.count:
+                del self.series[key]
 
-def read_reports():
-    if os.path.exists(REPORT_FILE):
-        with FileLock(LOCK_FILE):
-            with open(REPORT_FILE, 'r') as reports_file:
-                json_reports = reports_file.read()
-                try:
-                    return json.loads(json_reports)
-                except json.JSONDecodeError as je:
-                    time.sleep(2)
-        return read_reports()
+    def percentiles(self, quantiles, metric=None):
+        def stats(sketch):
+            result = {'count': sketch.count}
+            values = sketch.quantiles(quantiles)
+            for quantile, value in zip(quantiles, values):
+                result['p%g' % (quantile * 100)] = value
+            return result
+
+        result = {}
+        for key in sorted(self.series, key=lambda key: (key[0], key[1] or '', str(key[2]))):
+            name, dimension, value = key
+            if metric is not None and name != metric:
+                continue
+            if name not in result:
+                result[name] = {'all': None}
+                for breakdown in SummaryAggregates.DIMENSIONS:
+                    result[name][breakdown] = {}
+            if dimension is None:
+                result[name]['all'] = stats(self.series[key])
+            else:
+                result[name][dimension][value] = stats(self.series[key])
+        return result
+
+
+class PrefixIndex(object):
+    """Sorted distinct values of one report field with the ids holding each."""
+
+    def __init__(self):
+        self.keys = []
+        self.members = {}
+
+    def add(self, key, report_id):
+        if key not in self.members:
+            bisect.insort(self.keys, key)
+            self.members[key] = set()
+        self.members[key].add(report_id)
+
+    def remove(self, key, report_id):
+        self.members[key].discard(report_id)
+        if not self.members[key]:
+            del self.members[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def startswith(self, prefix):
+        report_ids = set()
+        index = bisect.bisect_left(self.keys, prefix)
+        while index < len(self.keys) and self.keys[index].startswith(prefix):
+            report_ids.update(self.members[self.keys[index]])
+            index = index + 1
+        return report_ids
+
+
+class ReportIndexes(object):
+    """Secondary indexes behind /query, /running and /failed."""
+
+    def __init__(self):
+        self.report_ids = set()
+        self.fields = {
+            'type': PrefixIndex(),
+            'image_name': PrefixIndex(),
+            'zone': PrefixIndex()
+        }
+        self.states = {
+            'running': set(),
+            'failed': set(),
+            'success': set()
+        }
+        # (start_time, report_id) of every report, the paging order
+        self.order = []
+        self.order_keys = {}
+
+    def _states(self, report):
+        states = []
+        success = (report.get('results') or {}).get('status') == 'SUCCESS'
+        duration = report.get('duration')
+        if duration == 0:
+            states.append('running')
+        if isinstance(duration, (int, float)) and duration > 0 and not success:
+            states.append('failed')
+        if success:
+            states.append('success')
+        return states
+
+    def _keys(self, report):
+        # (field, value) of the indexed fields a report holds a string for,
+        # a report without one is not found by a query on that field
+        for field in self.fields:
+            value = report.get(field)
+            if isinstance(value, str):
+                yield (field, value)
+
+    def add(self, report_id, report):
+        for field, value in self._keys(report):
+            self.fields[field].add(value, report_id)
+        for state in self._states(report):
+            self.states[state].add(report_id)
+        self.report_ids.add(report_id)
+        self.order_keys[report_id] = _order_key(report_id, report)
+        bisect.insort(self.order, self.order_keys[report_id])
+
+    def remove(self, report_id, report):
+        for field, value in self._keys(report):
+            self.fields[field].remove(value, report_id)
+        for state in self._states(report):
+            self.states[state].discard(report_id)
+        self.report_ids.discard(report_id)
+        del self.order[bisect.bisect_left(self.order, self.order_keys.pop(report_id))]
+
+    def query(self, qtype=None, qimage=None, qzone=None, qfailed=None, qsuccess=None):
+        return sorted(self.query_ids(qtype, qimage, qzone, qfailed, qsuccess))
+
+    def query_ids(self, qtype=None, qimage=None, qzone=None, qfailed=None, qsuccess=None):
+        candidates = []
+        if qtype:
+            candidates.append(self.fields['type'].startswith(qtype))
+        if qimage:
+            candidates.append(self.fields['image_name'].startswith(qimage))
+        if qzone:
+            candidates.append(self.fields['zone'].startswith(qzone))
+        if qsuccess:
+            candidates.append(self.states['success'])
+        if not candidates:
+            candidates.append(self.report_ids)
+        # intersect starting from the smallest candidate set
+        candidates.sort(key=len)
+        report_ids = set(candidates[0])
+        for other in candidates[1:]:
+            report_ids.intersection_update(other)
+        if qfailed:
+            # anything without a SUCCESS status, running tests included
+            report_ids.difference_update(self.states['success'])
+        return report_ids
+
+    def state(self, state):
+        return sorted(self.states[state])
+
+    def page(self, report_ids, after=None, limit=None):
+        # report_ids of None pages through every report without sorting
+        if report_ids is None:
+            index = 0
+            if after:
+                index = bisect.bisect_right(self.order, after)
+            return _page_keys(self.order[index:index + limit] if limit else self.order[index:],
+                              len(self.order) - index, limit)
+        return _page(report_ids, self.order_keys, after, limit)
+
+
+def _order_key(report_id, report):
+    return (report.get('start_time') or 0, report_id)
+
+
+def _page_keys(keys, available, limit):
+    next_key = None
+    if limit and available > limit:
+        next_key = keys[-1]
+    return ([key[1] for key in keys], next_key)
+
+
+def _page(report_ids, order_keys, after=None, limit=None):
+    keys = sorted(order_keys[report_id] for report_id in report_ids)
+    index = 0
+    if after:
+        index = bisect.bisect_right(keys, after)
+    return _page_keys(keys[index:index + limit] if limit else keys[index:],
+                      len(keys) - index, limit)
+
+
+def _result_code(value):
+    # result codes as floats, NaN when missing or not a number so they
+    # match neither 0, 1 nor > 0
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float('nan')
+
+
+class ReportColumns(object):
+    """The fields /summary, /running, /failed and /query read, one numpy
+    array per field with a row per report. Zone, type and image are stored
+    as codes into a list of their distinct values, and rows of removed
+    reports are reused."""
+
+    DIMENSIONS = ['zone', 'type', 'image_name']
+    COLUMNS = [
+        ('valid', 'bool'),
+        ('zone', 'int32'),
+        ('type', 'int32'),
+        ('image_name', 'int32'),
+        ('start_time', 'float64'),
+        ('duration', 'float64'),
+        ('success', 'bool'),
+        ('timedout', 'bool'),
+        ('workspace_create_result_code', 'float64'),
+        ('workspace_create_duration', 'float64'),
+        ('terraform_plan_result_code', 'float64'),
+        ('terraform_plan_duration', 'float64'),
+        ('terraform_apply_result_code', 'float64'),
+        ('terraform_apply_duration', 'float64'),
+        ('terraform_destroy', 'bool'),
+        ('terraform_destroy_duration', 'float64'),
+        ('terraform_result_code', 'float64'),
+        ('terraform_seconds', 'float64')
+    ]
+
+    def __init__(self):
+        self.rows = {}
+        self.ids = []
+        self.free = []
+        self.codes = {}
+        self.values = {}
+        for dimension in self.DIMENSIONS:
+            self.codes[dimension] = {}
+            self.values[dimension] = []
+        self.columns = {}
+        for name, dtype in self.COLUMNS:
+            self.columns[name] = numpy.zeros(0, dtype=dtype)
+        self.states = _ColumnStates(self)
+
+    def _code(self, dimension, value):
+        # reports missing a dimension share the code of None
+        codes = self.codes[dimension]
+        if value not in codes:
+            codes[value] = len(self.values[dimension])
+            self.values[dimension].append(value)
+        return codes[value]
+
+    def _row(self, report):
+        # the column values of one report, in COLUMNS order
+        terraform_result_code = _result_code(report.get('terraform_result_code'))
+        terraform_seconds = 0.0
+        if terraform_result_code == 0:
+            terraform_seconds = report.get('terraform_apply_stop', 0) - (report.get('start_time') or 0)
+        duration = report.get('duration')
+        if not isinstance(duration, (int, float)):
+            # neither running nor complete
+            duration = math.nan
+        results = report.get('results') or {}
+        return (
+            True,
+            self._code('zone', report.get('zone')),
+            self._code('type', report.get('type')),
+            self._code('image_name', report.get('image_name')),
+            report.get('start_time') or 0,
+            float(duration),
+            results.get('status') == 'SUCCESS',
+            'test timedout' in results,
+            _result_code(report.get('workspace_create_result_code')),
+            report.get('workspace_create_duration', 0),
+            _result_code(report.get('terraform_plan_result_code')),
+            report.get('terraform_plan_duration', 0),
+            _result_code(report.get('terraform_apply_result_code')),
+            report.get('terraform_apply_duration', 0),
+            'terraform_destroy_result_code' in report,
+            report.get('terraform_destroy_duration', 0),
+            terraform_result_code,
+            terraform_seconds
+        )
+
+    def _grow(self, size):
+        capacity = len(self.ids)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        for name, dtype in self.COLUMNS:
+            column = numpy.zeros(capacity, dtype=dtype)
+            column[:len(self.ids)] = self.columns[name]
+            self.columns[name] = column
+        self.free.extend(range(capacity - 1, len(self.ids) - 1, -1))
+        self.ids.extend([None] * (capacity - len(self.ids)))
+
+    def extend(self, reports):
+        # build from a whole store at once, far faster than add per report
+        rows = [self._row(reports[report_id]) for report_id in reports]
+        first = len(self.ids) - len(self.free)
+        self._grow(first + len(rows))
+        if not rows:
+            return
+        self.free = [row for row in self.free if row >= first + len(rows)]
+        for index, (name, dtype) in enumerate(self.COLUMNS):
+            self.columns[name][first:first + len(rows)] = \
+                numpy.array([row[index] for row in rows], dtype=dtype)
+        for row, report_id in enumerate(reports, first):
+            self.rows[report_id] = row
+            self.ids[row] = report_id
+
+    def add(self, report_id, report):
+        values = self._row(report)
+        if not self.free:
+            self._grow(len(self.ids) + 1)
+        row = self.free.pop()
+        for (name, dtype), value in zip(self.COLUMNS, values):
+            self.columns[name][row] = value
+        self.rows[report_id] = row
+        self.ids[row] = report_id
+
+    def remove(self, report_id, report):
+        row = self.rows.pop(report_id)
+        self.columns['valid'][row] = False
+        self.ids[row] = None
+        self.free.append(row)
+
+    def _report_ids(self, mask):
+        ids = self.ids
+        return set(ids[row] for row in numpy.flatnonzero(mask))
+
+    def _prefix(self, dimension, prefix):
+        # rows whose value of dimension starts with prefix
+        codes = [code for value, code in self.codes[dimension].items()
+                 if isinstance(value, str) and value.startswith(prefix)]
+        return numpy.isin(self.columns[dimension], codes)
+
+    def query_ids(self, qtype=None, qimage=None, qzone=None, qfailed=None, qsuccess=None):
+        columns = self.columns
+        mask = columns['valid'].copy()
+        if qtype:
+            mask &= self._prefix('type', qtype)
+        if qimage:
+            mask &= self._prefix('image_name', qimage)
+        if qzone:
+            mask &= self._prefix('zone', qzone)
+        if qsuccess:
+            mask &= columns['success']
+        if qfailed:
+            # anything without a SUCCESS status, running tests included
+            mask &= ~columns['success']
+        return self._report_ids(mask)
+
+    def page(self, report_ids, after=None, limit=None):
+        if report_ids is None:
+            report_ids = self.rows
+        start_time = self.columns['start_time']
+        order_keys = {}
+        for report_id in report_ids:
+            order_keys[report_id] = (float(start_time[self.rows[report_id]]), report_id)
+        return _page(report_ids, order_keys, after, limit)
+
+    def summary(self):
+        columns = self.columns
+        valid = columns['valid']
+        duration = columns['duration']
+        running = valid & (duration == 0)
+        complete = valid & (duration != 0) & ~numpy.isnan(duration)
+        success = complete & columns['success']
+        failed = complete & ~columns['success']
+        terraform_code = columns['terraform_result_code']
+        terraform_failed = failed & (terraform_code > 0)
+
+        def count(mask):
+            return int(numpy.count_nonzero(mask))
+
+        def completed(phase):
+            # count, seconds and failures of a phase
+            code = columns[phase + '_result_code']
+            done = valid & (code == 0)
+            return (count(done), float(columns[phase + '_duration'][done].sum()),
+                    count(valid & (code == 1)))
+
+        def average(total, number):
+            if number > 0:
+                return round(total / number, 2)
+            return 0
+
+        def breakdown(dimension):
+            codes = columns[dimension]
+            size = len(self.values[dimension])
+            reports = numpy.bincount(codes[valid], minlength=size)
+            counts = {}
+            for state, mask in [('running', running), ('success', success),
+                                ('failed', failed), ('terraform_failed', terraform_failed)]:
+                counts[state] = numpy.bincount(codes[mask], minlength=size)
+            stats = {}
+            for code in numpy.flatnonzero(reports):
+                done = int(counts['success'][code]) + int(counts['failed'][code])
+                percent_failure = 0
+                if done > 0:
+                    percent_failure = round((int(counts['failed'][code]) / done) * 100, 2)
+                stats[self.values[dimension][code]] = {
+                    'running': int(counts['running'][code]),
+                    'success': int(counts['success'][code]),
+                    'failed': int(counts['failed'][code]),
+                    'terraform_failed': int(counts['terraform_failed'][code]),
+                    'percent_failure': percent_failure
+                }
+            return stats
+
+        now = datetime.datetime.utcnow()
+        running_reports = []
+        start_time = columns['start_time']
+        for report_id in sorted(self._report_ids(running)):
+            row = self.rows[report_id]
+            running_reports.append("%s - %s seconds - %s - %s" % (
+                report_id, str(int(now.timestamp() - start_time[row])),
+                self.values['type'][columns['type'][row]],
+                self.values['zone'][columns['zone'][row]]))
+        success_durations = duration[success]
+        failed_durations = duration[failed]
+        num_success = len(success_durations)
+        num_failed = len(failed_durations)
+        terraform_completed = valid & (terraform_code == 0)
+        workspace_create = completed('workspace_create')
+        terraform_plan = completed('terraform_plan')
+        terraform_apply = completed('terraform_apply')
+        # destroy is counted by the apply result, as scan_summary does
+        destroy = valid & columns['terraform_destroy']
+        apply_code = columns['terraform_apply_result_code']
+        terraform_destroy = (count(destroy & (apply_code == 0)),
+                             float(columns['terraform_destroy_duration'][destroy & (apply_code == 0)].sum()),
+                             count(destroy & (apply_code == 1)))
+        return {
+            'total_tests': count(valid),
+            'running_tests': running_reports,
+            'success_tests': num_success,
+            'success_avg_duration': average(float(success_durations.sum()), num_success),
+            'success_duration_min': round(float(success_durations.min()), 2) if num_success else 0,
+            'success_duration_max': round(float(success_durations.max()), 2) if num_success else 0,
+            'failed_tests': num_failed,
+            'failed_avg_duration': average(float(failed_durations.sum()), num_failed),
+            'failed_duration_min': round(float(failed_durations.min()), 2) if num_failed else 0,
+            'failed_duration_max': round(float(failed_durations.max()), 2) if num_failed else 0,
+            'failed_in_terraform': count(terraform_failed),
+            'failed_by_timeout': count(failed & columns['timedout']),
+            'terraform_completed': count(terraform_completed),
+            'terraform_completed_avg': average(float(columns['terraform_seconds'][terraform_completed].sum()),
+                                               count(terraform_completed)),
+            'workspace_create_completed': workspace_create[0],
+            'workspace_create_completed_avg': average(workspace_create[1], workspace_create[0]),
+            'workspace_create_failed': workspace_create[2],
+            'terraform_plan_completed': terraform_plan[0],
+            'terraform_plan_completed_avg': average(terraform_plan[1], terraform_plan[0]),
+            'terraform_plan_failed': terraform_plan[2],
+            'terraform_apply_completed': terraform_apply[0],
+            'terraform_apply_completed_avg': average(terraform_apply[1], terraform_apply[0]),
+            'terraform_apply_failed': terraform_apply[2],
+            'terraform_destroy_completed': terraform_destroy[0],
+            'terraform_destroy_completed_avg': average(terraform_destroy[1], terraform_destroy[0]),
+            'terraform_destroy_failed': terraform_destroy[2],
+            'zones_summary': breakdown('zone'),
+            'test_types': breakdown('type'),
+            'image_names': breakdown('image_name')
+        }
+
+
+class _ColumnStates(object):
+    """view.states['running'] and the like for ReportColumns, matching
+    ReportIndexes."""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, state):
+        columns = self.columns.columns
+        valid = columns['valid']
+        duration = columns['duration']
+        if state == 'running':
+            return self.columns._report_ids(valid & (duration == 0))
+        if state == 'failed':
+            return self.columns._report_ids(valid & (duration > 0) & ~columns['success'])
+        return self.columns._report_ids(valid & columns['success'])
+
+
+REPORT_VIEWS = {
+    'summary': SummaryAggregates,
+    'rollups': SummaryRollups,
+    'sketches': DurationSketches,
+    'indexes': ReportIndexes,
+    'columns': ReportColumns
+}
+
+
+def _scannable(reports):
+    # the reports holding every field the scans read, the scans index
+    # them directly
+    scannable = {}
+    for report_id, report in reports.items():
+        if all(isinstance(report.get(field), str) for field in SummaryAggregates.DIMENSIONS) and \
+                isinstance(report.get('duration'), (int, float)) and \
+                isinstance(report.get('results'), dict):
+            scannable[report_id] = report
+    return scannable
+
+
+def _summary_mismatches(expected, actual):
+    mismatches = []
+    for key in expected:
+        if key == 'running_tests':
+            # the running time of each test depends on when it was read
+            same = sorted(line.split(' - ')[0] for line in expected[key]) == \
+                sorted(line.split(' - ')[0] for line in actual[key])
+        elif isinstance(expected[key], float):
+            same = abs(expected[key] - actual[key]) <= 0.01
+        else:
+            same = expected[key] == actual[key]
+        if not same:
+            mismatches.append(key)
+    return mismatches
+
+
+def verify_summary():
+    # compare the incremental aggregates with aggregates rebuilt from the
+    # reports, and those with a full scan of the reports it can read,
+    # returning the keys that disagree
+    reports, incremental = read_view('summary', lambda view, reports: (reports, view.summary()))
+    mismatches = _summary_mismatches(_build_view('summary', reports).summary(), incremental)
+    scannable = _scannable(reports)
+    for key in _summary_mismatches(scan_summary(scannable),
+                                   _build_view('summary', scannable).summary()):
+        if key not in mismatches:
+            mismatches.append(key)
+    return mismatches
+
+
+def _index_lookups(reports):
+    lookups = [('running', {}), ('failed', {})]
+    for flags in [{}, {'qfailed': '1'}, {'qsuccess': '1'}]:
+        lookups.append(('query', dict(flags)))
+        for report in reports.values():
+            for field, argument in [('type', 'qtype'), ('image_name', 'qimage'), ('zone', 'qzone')]:
+                lookup = ('query', dict(flags))
+                lookup[1][argument] = report[field][:3]
+                if lookup not in lookups:
+                    lookups.append(lookup)
+    return lookups
+
+
+def _index_answers(view, lookups):
+    answers = []
+    for name, arguments in lookups:
+        if name == 'query':
+            answers.append(view.query(**arguments))
+        else:
+            answers.append(view.state(name))
+    return answers
+
+
+def verify_indexes():
+    # compare the indexes with indexes rebuilt from the reports, and those
+    # with full scans of the reports the scans can read, returning the
+    # lookups that disagree
+    def answer(view, reports):
+        lookups = _index_lookups(_scannable(reports))
+        return reports, lookups, _index_answers(view, lookups)
+
+    reports, lookups, indexed = read_view('indexes', answer)
+    rebuilt = _index_answers(_build_view('indexes', reports), lookups)
+    scannable = _scannable(reports)
+    readable = _index_answers(_build_view('indexes', scannable), lookups)
+    mismatches = []
+    for lookup, index, rebuild, read in zip(lookups, indexed, rebuilt, readable):
+        name, arguments = lookup
+        if name == 'query':
+            scanned = scan_query(scannable, **arguments)
+        else:
+            scanned = SCANS[name](scannable)
+        if index != rebuild or sorted(scanned) != read:
+            mismatches.append(lookup)
+    return mismatches
+
+
+def _response_mimetype():
+    # MessagePack when the client prefers it and it is installed
+    if msgpack is not None:
+        best = request.accept_mimetypes.best_match(
+            ['application/json'] + MSGPACK_MIMETYPES, default='application/json')
+        if best in MSGPACK_MIMETYPES:
+            return best
+    return 'application/json'
+
+
+def _encode(data, mimetype):
+    started = time.perf_counter()
+    if mimetype in MSGPACK_MIMETYPES:
+        body = msgpack.packb(data, use_bin_type=True)
+    elif request.args.get('pretty'):
+        body = json.dumps(data, sort_keys=True,
+                          indent=4, separators=(',', ': ')).encode('utf-8')
     else:
-        return {}
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    response_encode.observe(time.perf_counter() - started)
+    _record_phase('serialize', time.perf_counter() - started)
+    return body
 
 
-def read_reports_json():
-    if os.path.exists(REPORT_FILE):
-        with FileLock(LOCK_FILE):
-            with open(REPORT_FILE, 'r') as reports_file:
-                reports_json = reports_file.read()
-                return reports_json
+def _encode_body(data, mimetype):
+    # the encoded body and whether it was gzipped for the client
+    body = _encode(data, mimetype)
+    if len(body) >= GZIP_MIN_BYTES and request.accept_encodings['gzip']:
+        return (gzip.compress(body, GZIP_LEVEL), True)
+    return (body, False)
+
+
+def _body_response(body, mimetype, gzipped, status=200):
+    response = app.response_class(response=body,
+                                  status=status, mimetype=mimetype)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+
+def _data_response(data, status=200):
+    mimetype = _response_mimetype()
+    body, gzipped = _encode_body(data, mimetype)
+    return _body_response(body, mimetype, gzipped, status)
+
+
+def _fields():
+    # the paths asked for by fields=zone,results.status as a sorted tuple,
+    # None for whole reports; a path inside another one adds nothing
+    value = request.args.get('fields')
+    if not value:
+        return None
+    fields = []
+    for path in sorted(set(path.strip() for path in value.split(','))):
+        if path and not any(path.startswith(field + '.') for field in fields):
+            fields.append(path)
+    return tuple(fields)
+
+
+def _project(report, fields):
+    projected = {}
+    for path in fields:
+        names = path.split('.')
+        value = report
+        for name in names:
+            if not isinstance(value, dict) or name not in value:
+                break
+            value = value[name]
+        else:
+            target = projected
+            for name in names[:-1]:
+                target = target.setdefault(name, {})
+            target[names[-1]] = value
+    return projected
+
+
+def _present(report, fields=None):
+    # the report as returned, projected onto fields with only the blobs
+    # among them read back in
+    if fields is None:
+        return _load_blobs(report)
+    return _project(_load_blobs(report, set(path.split('.')[0] for path in fields)), fields)
+
+
+def _cached_response(reports):
+    # GET /report reuses the body encoded for the same reports, the cached
+    # dict is replaced on every change so identity marks the version
+    mimetype = _response_mimetype()
+    fields = _fields()
+    variant = (mimetype, bool(request.args.get('pretty')),
+               bool(request.accept_encodings['gzip']), fields)
+    with _encoded_lock:
+        if _encoded_bodies['reports'] is not reports:
+            _encoded_bodies['reports'] = reports
+            _encoded_bodies['bodies'] = {}
+        encoded = _encoded_bodies['bodies'].get(variant)
+    if encoded is None:
+        _count_event('response_cache_misses')
+        presented = {}
+        for report_id in reports:
+            presented[report_id] = _present(reports[report_id], fields)
+        encoded = _encode_body(presented, mimetype)
+        with _encoded_lock:
+            if _encoded_bodies['reports'] is reports:
+                _encoded_bodies['bodies'][variant] = encoded
     else:
-        return "{}"
+        _count_event('response_cache_hits')
+    return _body_response(encoded[0], mimetype, encoded[1])
 
 
-def add_report(report_id, report):
-    if not os.path.exists(REPORT_FILE):
-        with FileLock(LOCK_FILE):
-            with open(REPORT_FILE, 'w') as reports_file:
-                reports = {}
-                reports[report_id] = report
-                reports_file.write(json.dumps(reports, sort_keys=True,
-                                              indent=4, separators=(',', ': ')))
+def _etag(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode(
+        'utf-8')).hexdigest()[:24]
+
+
+def _variant():
+    # what besides the data decides the bytes of a response
+    return [request.path, sorted(request.args.items(multi=True)),
+            _response_mimetype(), bool(request.accept_encodings['gzip'])]
+
+
+def _not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+
+def conditional(clock=None):
+    # answer GET with 304 Not Modified while the store signature, which is
+    # the same in every worker, still matches the client's ETag. clock
+    # returns anything else the response depends on for a signature
+    def decorator(route):
+        @functools.wraps(route)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return route(*args, **kwargs)
+            signature = STORE.signature()
+            parts = [signature] + _variant()
+            if clock:
+                parts.append(clock(signature))
+            etag = _etag(*parts)
+            if request.if_none_match.contains(etag):
+                return _not_modified(etag)
+            response = route(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def _rollup_query():
+    for name in ['since', 'until', 'bucket']:
+        if name in request.args:
+            return True
+    return False
+
+
+# ISO 8601 forms accepted for times, strptime as fromisoformat needs 3.7
+ISO_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+ISO_OFFSET = re.compile(r'(Z|([+-])(\d\d):?(\d\d))$')
+
+
+def _parse_time(value):
+    # epoch seconds of an ISO 8601 time, UTC unless it has an offset, or
+    # None when it is not one
+    offset = 0
+    match = ISO_OFFSET.search(value)
+    if match:
+        value = value[:match.start()]
+        if match.group(2):
+            offset = (int(match.group(3)) * 60 + int(match.group(4))) * 60
+            if match.group(2) == '-':
+                offset = -offset
+    for iso_format in ISO_FORMATS:
+        try:
+            moment = datetime.datetime.strptime(value.replace(' ', 'T'), iso_format)
+        except ValueError:
+            continue
+        return moment.replace(tzinfo=datetime.timezone.utc).timestamp() - offset
+    return None
+
+
+def _time_argument(name, default):
+    # epoch seconds or an ISO 8601 time
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = _parse_time(value)
+    # nan and inf can not be rounded to a bucket
+    if seconds is None or not math.isfinite(seconds) or abs(seconds) > 1e11:
+        abort(400)
+    return seconds
+
+
+def _summary_clock(signature):
+    # running durations in /summary move every second while tests run,
+    # rollups only count completed reports. Asked of the view answering
+    # the request, brought up to date with the store first, so it holds
+    # for the first request after a write in any worker
+    if _rollup_query():
+        return None
+    if _engine() == 'columns' and not request.args.get('scan'):
+        running = read_view('columns', lambda view, reports: bool(view.states['running']))
     else:
-        with FileLock(LOCK_FILE):
-            reports_json = None
-            with open(REPORT_FILE, 'r') as reports_file:
-                reports_json = reports_file.read()
-            if reports_json:
-                reports = json.loads(reports_json)
-                reports[report_id] = report
-                with open(REPORT_FILE, 'w') as reports_file:
-                    reports_file.write(json.dumps(reports, sort_keys=True,
-                                                  indent=4, separators=(',', ': ')))
+        running = read_view('summary', lambda view, reports: bool(view.running))
+    if running:
+        return int(time.time())
+    return None
 
 
-def delete_report(report_id):
-    if os.path.exists(REPORT_FILE):
-        with FileLock(LOCK_FILE):
-            reports_json = None
-            with open(REPORT_FILE, 'r') as reports_file:
-                reports_json = reports_file.read()
-            if reports_json:
-                reports = json.loads(reports_json)
-                try:
-                    del reports[report_id]
-                except KeyError:
-                    pass
-                with open(REPORT_FILE, 'w') as reports_file:
-                    reports_file.write(json.dumps(reports, sort_keys=True,
-                                                  indent=4, separators=(',', ': ')))
+def _report_etag(report_id, report):
+    # scoped to one report, whose digest is computed once per version of
+    # it; cached reports are replaced rather than modified so identity is
+    # the version
+    with _etag_lock:
+        digest = None
+        if report_id in _report_etags and _report_etags[report_id][0] is report:
+            digest = _report_etags[report_id][1]
+    if digest is None:
+        digest = hashlib.sha1(json.dumps(report, sort_keys=True).encode(
+            'utf-8')).hexdigest()
+        with _etag_lock:
+            if len(_report_etags) > 2 * len(read_reports()) + 1000:
+                _report_etags.clear()
+            _report_etags[report_id] = (report, digest)
+    return _etag(digest, _variant())
 
 
-def delete_reports():
-    if os.path.exists(REPORT_FILE):
-        with FileLock(LOCK_FILE):
-            os.unlink(REPORT_FILE)
+# fields every view reads, which an update may not remove, and the type
+# it may set them to
+REQUIRED_FIELDS = {
+    'zone': str,
+    'type': str,
+    'image_name': str,
+    'start_time': float,
+    'duration': float,
+    'results': dict
+}
 
 
-@app.route('/start/<uuid:test_id>', methods=['POST'])
-def start_test(test_id):
-    test_id = str(test_id)
-    report = request.json
-    now = datetime.datetime.utcnow()
+def _valid_update(update):
+    # whether a PUT, PATCH or batch update or patch keeps the fields the
+    # views depend on, and of the type they read
+    if not isinstance(update, dict):
+        return False
+    for name, kind in REQUIRED_FIELDS.items():
+        if name not in update:
+            continue
+        value = update[name]
+        if kind is float:
+            # a finite number, bool being an int
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                    not math.isfinite(value):
+                return False
+        elif not isinstance(value, kind):
+            return False
+    return True
+
+
+def _start_report(report, now):
     report['start_time'] = now.timestamp()
     report['readable_start_time'] = now.strftime('%Y-%m-%d %H:%M:%S UTC')
     report['stop_time'] = None
     report['readable_stop_time'] = None
     report['duration'] = 0
     report['results'] = {}
-    add_report(test_id, report)
+    return report
+
+
+def _stop_report(report, results, now):
+    report['stop_time'] = now.timestamp()
+    report['readable_stop_time'] = now.strftime('%Y-%m-%d %H:%M:%S UTC')
+    report['duration'] = (now.timestamp() - report['start_time'])
+    report['results'] = results
+    return report
+
+
+@app.route('/start/<uuid:test_id>', methods=['POST'])
+def start_test(test_id):
+    test_id = str(test_id)
+    report = request.json
+    now = datetime.datetime.utcnow()
+    add_report(test_id, _start_report(report, now))
     return app.response_class(status=200)
 
 
 @app.route('/stop/<uuid:test_id>', methods=['POST'])
 def stop_test(test_id):
-    reports = read_reports()
     test_id = str(test_id)
-    if test_id in reports:
-        report = reports[test_id]
-        now = datetime.datetime.utcnow()
+    try:
         results = json.loads(request.data.decode('utf-8'))
-        report['stop_time'] = now.timestamp()
-        report['readable_stop_time'] = now.strftime('%Y-%m-%d %H:%M:%S UTC')
-        report['duration'] = (now.timestamp() - report['start_time'])
-        report['results'] = results
-        add_report(test_id, report)
-        return app.response_class(status=200)
-    else:
+    except ValueError:
+        abort(400)
+    if not isinstance(results, dict):
+        abort(400)
+    # under the store lock, so an update made meanwhile is not lost
+    report = _update_report(test_id, lambda report: _stop_report(
+        dict(report), results, datetime.datetime.utcnow()))
+    if report is None:
         abort(404)
+    return app.response_class(status=200)
+
+
+def _apply_operation(reports, operation, now):
+    # returns the status of one batch operation and the change it makes
+    try:
+        test_id = str(uuid.UUID(operation['id']))
+        op = operation['op']
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return (400, None)
+    data = operation.get('data')
+    if op == 'start':
+        if not isinstance(data, dict):
+            return (400, None)
+        return (200, (test_id, _start_report(dict(data), now)))
+    if op == 'delete':
+        ARCHIVE.delete(test_id)
+        return (200, (test_id, None))
+    if op not in ['stop', 'update', 'patch']:
+        return (400, None)
+    if op == 'stop' and not isinstance(data, dict):
+        return (400, None)
+    if op != 'stop' and not _valid_update(data):
+        return (400, None)
+    if test_id not in reports or reports[test_id] is None:
+        return (404, None)
+    if op == 'patch':
+        return (200, (test_id, _merge_patch(reports[test_id], data)))
+    report = copy.deepcopy(reports[test_id])
+    if op == 'stop':
+        return (200, (test_id, _stop_report(report, data, now)))
+    for prop in data:
+        report[prop] = data[prop]
+    return (200, (test_id, report))
+
+
+@app.route('/batch', methods=['POST'])
+def batch_operations():
+    operations = request.json
+    if not isinstance(operations, list):
+        abort(400)
+    results = []
+
+    def update(reports):
+        # later operations see the effect of earlier ones in the batch
+        pending = {}
+        changes = []
+        now = None
+        for operation in operations:
+            if not isinstance(operation, dict):
+                results.append({'status': 400})
+                continue
+            # strictly increasing, so a test started and stopped in one
+            # batch never ends with the zero duration of a running test
+            previous = now
+            now = datetime.datetime.utcnow()
+            if previous is not None and now <= previous:
+                now = previous + datetime.timedelta(microseconds=1)
+            status, change = _apply_operation(
+                _Overlay(reports, pending), operation, now)
+            results.append({
+                'id': operation.get('id'),
+                'op': operation.get('op'),
+                'status': status
+            })
+            if change:
+                pending[change[0]] = change[1]
+                changes.append(change)
+        return changes
+    report_ids = set()
+    for operation in operations:
+        try:
+            report_ids.add(str(uuid.UUID(operation['id'])))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            pass
+    update_reports(update, sorted(report_ids))
+    return _data_response(results)
 
 
 @app.route('/report', methods=['GET', 'DELETE'])
+@conditional()
 def test_reports():
     if request.method == 'DELETE':
         delete_reports()
         return app.response_class(response='',
                                   status=200, mimetype='application/json')
+    elif request.args.get('stream') or _paging() is not None:
+        entries, next_key = _list_reports(lambda view: None)
+        return _listing_response(entries, next_key, as_dict=True)
     else:
-        reports = read_reports_json()
-        return app.response_class(response=reports,
-                                  status=200, mimetype='application/json')
+        return _cached_response(read_reports())
+
 
+def _update_report(report_id, change):
+    # replace the report with change(report) under the store lock, so
+    # concurrent updates are not lost. The new report, None without one
+    updated = []
 
-@app.route('/report/<uuid:test_id>', methods=['GET', 'DELETE', 'PUT'])
+    def update(reports):
+        if report_id not in reports or reports[report_id] is None:
+            return []
+        updated.append(change(reports[report_id]))
+        return [(report_id, updated[0])]
+    update_reports(update, [report_id])
+    return updated[0] if updated else None
+
+
+@app.route('/report/<uuid:test_id>', methods=['GET', 'DELETE', 'PUT', 'PATCH'])
 def report_on_test(test_id):
     test_id = str(test_id)
     if request.method == 'DELETE':
         delete_report(test_id)
         return app.response_class(response='',
                                   status=200, mimetype='application/json')
-    elif request.method == 'PUT':
-        reports = read_reports()
-        test_id = str(test_id)
-        if test_id in reports:
-            report = reports[test_id]
-            update = request.json
-            for prop in update:
-                report[prop] = update[prop]
-            add_report(test_id, report)
-            return app.response_class(response=json.dumps(report),
-                                      status=200, content_type='application/json')
+    elif request.method in ['PUT', 'PATCH']:
+        update = request.get_json(force=True, silent=True)
+        if not _valid_update(update):
+            abort(400)
+        if request.method == 'PUT':
+            # the fields given replace those of the report
+            report = _update_report(test_id, lambda report: dict(report, **update))
         else:
+            # an RFC 7386 merge patch, null removing a field
+            report = _update_report(test_id, lambda report: _merge_patch(report, update))
+        if report is None:
             abort(404)
+        return _data_response(_present(report, _fields()))
     else:
         reports = read_reports()
-        if test_id in reports:
-            json_report = json.dumps(reports[test_id], sort_keys=True,
-                                     indent=4, separators=(',', ': '))
-            return app.response_class(response=json_report,
-                                      status=200, mimetype='application/json')
-        else:
+        report = reports.get(test_id)
+        if report is None:
+            report = ARCHIVE.find(test_id)
+        if report is None:
             abort(404)
+        etag = _report_etag(test_id, report)
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        response = _data_response(_present(report, _fields()))
+        response.set_etag(etag)
+        return response
 
 
-@app.route('/running', methods=['GET'])
-def running_reports():
-    reports = read_reports()
+def scan_running(reports):
     return_reports = []
     for report in reports:
         if reports[report]['duration'] == 0:
-            return_reports.append(reports[report])
-    json_report = json.dumps(return_reports, sort_keys=True,
-                             indent=4, separators=(',', ': '))
-    return app.response_class(response=json_report,
-                              status=200, mimetype='application/json')
+            return_reports.append(report)
+    return return_reports
 
 
-@app.route('/failed', methods=['GET'])
-def failed_reports():
-    reports = read_reports()
+def scan_failed(reports):
     return_reports = []
     for report in reports:
         if reports[report]['duration'] > 0:
             if 'status' not in reports[report]['results'] or not reports[report]['results']['status'] == 'SUCCESS':
-                return_reports.append(reports[report])
-    json_report = json.dumps(return_reports, sort_keys=True,
-                             indent=4, separators=(',', ': '))
-    return app.response_class(response=json_report,
-                              status=200, mimetype='application/json')
+                return_reports.append(report)
+    return return_reports
 
 
-@app.route('/query', methods=['GET'])
-def query_attributes():
-    qtype = request.args.get('type')
-    qimage = request.args.get('image')
-    qzone = request.args.get('zone')
-    qfailed = request.args.get('failed')
-    qsuccess = request.args.get('success')
-    reports = read_reports()
+def scan_query(reports, qtype=None, qimage=None, qzone=None, qfailed=None, qsuccess=None):
     return_reports = []
     for report in reports:
         add_report = True
@@ -224,16 +3143,187 @@ def query_attributes():
         if qsuccess and not ('status' in reports[report]['results'] and reports[report]['results']['status'] == 'SUCCESS'):
             add_report = False
         if add_report:
-            return_reports.append(reports[report])
-    json_report = json.dumps(return_reports, sort_keys=True,
-                             indent=4, separators=(',', ': '))
-    return app.response_class(response=json_report,
-                              status=200, mimetype='application/json')
+            return_reports.append(report)
+    return return_reports
 
 
-@app.route('/summary', methods=['GET'])
-def summary():
-    reports = read_reports()
+SCANS = {
+    'running': scan_running,
+    'failed': scan_failed
+}
+
+
+def _paging():
+    # (after, limit) from the cursor and limit arguments, or None when the
+    # listing is not paginated
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if cursor is None and limit is None:
+        return None
+    after = None
+    try:
+        if limit:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        else:
+            limit = None
+        if cursor:
+            after = tuple(json.loads(base64.urlsafe_b64decode(
+                cursor.encode('utf-8')).decode('utf-8')))
+            # a (start_time, report_id) order key
+            if len(after) != 2 or isinstance(after[0], bool) or \
+                    not isinstance(after[0], (int, float)) or not isinstance(after[1], str):
+                raise ValueError('cursor is not an order key')
+    except Exception:
+        abort(400)
+    return (after, limit)
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('utf-8')
+
+
+def _engine():
+    # the view answering this request, ?engine= overriding QUERY_ENGINE
+    engine = request.args.get('engine', QUERY_ENGINE)
+    if engine not in ['indexes', 'columnar']:
+        abort(400)
+    if engine == 'columnar' and numpy is not None:
+        return 'columns'
+    return 'indexes'
+
+
+def _list_reports(select, scan=None):
+    # select picks the matching ids from the indexes, None for every
+    # report, scan finds them without the indexes when ?scan is given.
+    # Paginated listings are ordered by start_time then id, the others by
+    # id. Returns ([(report_id, report)], next_key)
+    paging = _paging()
+    if scan and request.args.get('scan'):
+        reports = read_reports()
+        report_ids = scan(reports)
+        if paging is None:
+            return ([(report, reports[report]) for report in report_ids], None)
+        order_keys = {}
+        for report in report_ids:
+            order_keys[report] = _order_key(report, reports[report])
+        report_ids, next_key = _page(report_ids, order_keys, *paging)
+        return ([(report, reports[report]) for report in report_ids], next_key)
+
+    def reader(view, reports):
+        report_ids = select(view)
+        next_key = None
+        if paging is not None:
+            report_ids, next_key = view.page(report_ids, *paging)
+        elif report_ids is None:
+            report_ids = reports
+        else:
+            report_ids = sorted(report_ids)
+        return ([(report, reports[report]) for report in report_ids], next_key)
+    return read_view(_engine(), reader)
+
+
+def _stream_json(entries, as_dict=False, pretty=False):
+    # yields the document one report at a time so a large listing is never
+    # held in memory as a single string
+    yield '{' if as_dict else '['
+    for index, (report_id, report) in enumerate(entries):
+        if pretty:
+            chunk = json.dumps(report, sort_keys=True,
+                               indent=4, separators=(',', ': '))
+        else:
+            chunk = json.dumps(report, separators=(',', ':'))
+        if as_dict:
+            chunk = json.dumps(report_id) + ': ' + chunk
+        yield (',\n' if index else '\n') + chunk
+    yield '\n}' if as_dict else '\n]'
+
+
+def _listing_response(entries, next_key=None, as_dict=False):
+    fields = _fields()
+    # a generator, so a streamed listing reads blobs as it goes
+    entries = ((report_id, _present(report, fields)) for report_id, report in entries)
+    if request.args.get('stream'):
+        response = app.response_class(
+            response=_stream_json(entries, as_dict, bool(request.args.get('pretty'))),
+            status=200, mimetype='application/json')
+    else:
+        if as_dict:
+            return_reports = dict(entries)
+        else:
+            return_reports = [report for report_id, report in entries]
+        response = _data_response(return_reports)
+    if next_key:
+        response.headers['X-Next-Cursor'] = _encode_cursor(next_key)
+    return response
+
+
+@app.route('/running', methods=['GET'])
+@conditional()
+def running_reports():
+    entries, next_key = _list_reports(
+        lambda view: view.states['running'], SCANS['running'])
+    return _listing_response(entries, next_key)
+
+
+@app.route('/failed', methods=['GET'])
+@conditional()
+def failed_reports():
+    entries, next_key = _list_reports(
+        lambda view: view.states['failed'], SCANS['failed'])
+    return _listing_response(entries, next_key)
+
+
+@app.route('/query', methods=['GET'])
+@conditional()
+def query_attributes():
+    qtype = request.args.get('type')
+    qimage = request.args.get('image')
+    qzone = request.args.get('zone')
+    qfailed = request.args.get('failed')
+    qsuccess = request.args.get('success')
+    since = _time_argument('since', None)
+    until = _time_argument('until', None)
+    if since is None and until is None:
+        entries, next_key = _list_reports(
+            lambda view: view.query_ids(qtype, qimage, qzone, qfailed, qsuccess),
+            lambda reports: scan_query(reports, qtype, qimage, qzone, qfailed, qsuccess))
+        return _listing_response(entries, next_key)
+
+    # a start_time range, answered from the store and from the archive
+    # segments that overlap it
+    def reader(view, reports):
+        first = 0
+        last = len(view.order)
+        if since is not None:
+            first = bisect.bisect_left(view.order, (since,))
+        if until is not None:
+            last = bisect.bisect_left(view.order, (until,))
+        report_ids = view.query_ids(qtype, qimage, qzone, qfailed, qsuccess)
+        matches = {}
+        for start_time, report_id in view.order[first:last]:
+            if report_id in report_ids:
+                matches[report_id] = reports[report_id]
+        return matches
+    matches = read_view('indexes', reader)
+    archived = dict(ARCHIVE.scan(since, until))
+    for report_id in scan_query(archived, qtype, qimage, qzone, qfailed, qsuccess):
+        if report_id not in matches:
+            matches[report_id] = archived[report_id]
+    paging = _paging()
+    next_key = None
+    if paging is None:
+        report_ids = sorted(matches)
+    else:
+        order_keys = {}
+        for report_id in matches:
+            order_keys[report_id] = _order_key(report_id, matches[report_id])
+        report_ids, next_key = _page(matches, order_keys, *paging)
+    return _listing_response([(report_id, matches[report_id]) for report_id in report_ids], next_key)
+
+
+def scan_summary(reports):
     zones = {}
     ttypes = {}
     imagez = {}
@@ -447,12 +3537,449 @@ def summary():
         'test_types': ttypes,
         'image_names': imagez
     }
-    json_report = json.dumps(return_data, sort_keys=True,
-                             indent=4, separators=(',', ': '))
-    return app.response_class(response=json_report,
-                              status=200, mimetype='application/json')
+    return return_data
+
+
+@app.route('/summary', methods=['GET'])
+@conditional(_summary_clock)
+def summary():
+    if _rollup_query():
+        since = _time_argument('since', 0)
+        until = _time_argument('until', None)
+        bucket = request.args.get('bucket')
+        if bucket is not None and bucket not in ROLLUP_BUCKETS:
+            abort(400)
+        return_data = read_view(
+            'rollups', lambda view, reports: view.summary(since, until, bucket))
+    elif request.args.get('scan'):
+        return_data = scan_summary(read_reports())
+    else:
+        name = 'columns' if _engine() == 'columns' else 'summary'
+        return_data = read_view(name, lambda view, reports: view.summary())
+    return _data_response(return_data)
+
+
+@app.route('/percentiles', methods=['GET'])
+@conditional()
+def percentiles():
+    metric = request.args.get('metric')
+    if metric is not None and metric not in ['duration', 'terraform'] + SKETCH_PHASES:
+        abort(400)
+    try:
+        quantiles = [float(quantile) for quantile in
+                     request.args.get('q', '0.5,0.9,0.99').split(',')]
+    except ValueError:
+        abort(400)
+    for quantile in quantiles:
+        if not 0 <= quantile <= 1:
+            abort(400)
+    return_data = read_view(
+        'sketches', lambda view, reports: view.percentiles(quantiles, metric))
+    return _data_response(return_data)
+
+
+def _event_sequence():
+    # (sequence, reset) to resume from. Without since or Last-Event-ID
+    # only events from now on are sent; an id numbered by another worker
+    # or before a restart resets the client to now
+    event_id = request.args.get('since', request.headers.get('Last-Event-ID'))
+    if event_id is None:
+        return (FEED.sequence, False)
+    sequence = FEED.parse_id(event_id)
+    if sequence is None:
+        return (FEED.sequence, True)
+    return (sequence, False)
+
+
+def _watch_events(sequence, timeout):
+    # wait for events after sequence, looking at the store every second
+    # so writes made by other workers are noticed
+    deadline = time.monotonic() + timeout
+    while True:
+        events, missed = FEED.wait(sequence, min(1.0, max(0, deadline - time.monotonic())))
+        if events or missed or time.monotonic() >= deadline:
+            return (events, missed)
+        read_reports()
+
+
+_event_slots = threading.BoundedSemaphore(EVENT_STREAMS)
+
+
+def _event_slot():
+    # take one of the EVENT_STREAMS slots, or answer 503 so waiting
+    # clients can not hold every request thread of the worker
+    if not _event_slots.acquire(blocking=False):
+        _count_event('event_streams_refused')
+        response = _data_response({'error': 'too many event streams'}, 503)
+        response.headers['Retry-After'] = str(int(EVENT_HEARTBEAT))
+        abort(response)
+
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+    sequence, reset = _event_sequence()
+    _event_slot()
+
+    def stream(sequence, reset):
+        # a reset event tells the client events were dropped, or that its
+        # id means nothing to this worker, and it should fetch the reports
+        # again; its id is where to resume from
+        while True:
+            if reset:
+                events, missed = ([], True)
+                reset = False
+            else:
+                events, missed = _watch_events(sequence, EVENT_HEARTBEAT)
+            if missed and not events:
+                sequence = FEED.sequence
+            if missed:
+                yield 'id: %s\nevent: reset\ndata: {}\n\n' % FEED.event_id(sequence)
+            for event in events:
+                sequence = event['seq']
+                yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+                    FEED.event_id(sequence), event['event'],
+                    json.dumps(event, separators=(',', ':')))
+            if not events and not missed:
+                yield ': keep-alive\n\n'
+    response = app.response_class(response=stream(sequence, reset),
+                                  status=200, mimetype='text/event-stream')
+    # the slot is given back once the server closes the stream
+    response.call_on_close(_event_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/events/poll', methods=['GET'])
+def event_poll():
+    sequence, reset = _event_sequence()
+    try:
+        timeout = min(float(request.args.get('timeout', '30')), EVENT_POLL_TIMEOUT)
+    except ValueError:
+        abort(400)
+    if reset:
+        events, missed = ([], True)
+    else:
+        _event_slot()
+        try:
+            events, missed = _watch_events(sequence, timeout)
+        finally:
+            _event_slots.release()
+    next_sequence = events[-1]['seq'] if events else sequence
+    if missed and not events:
+        next_sequence = FEED.sequence
+    return _data_response({
+        'events': events,
+        'reset': missed,
+        'next': FEED.event_id(next_sequence)
+    })
+
+
+_profile_lock = threading.Lock()
+
+
+def _profile_modes():
+    # the profiles asked for, aborting unless the admin token was sent
+    modes = request.headers.get('X-Profile', request.args.get('profile'))
+    if not modes:
+        return None
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+    modes = set(modes.split(','))
+    if not modes or not modes <= {'cpu', 'memory'}:
+        abort(400)
+    return modes
+
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    g.phases = {}
+    modes = _profile_modes()
+    if modes:
+        # the profilers are process wide, so one request at a time
+        if not _profile_lock.acquire(blocking=False):
+            abort(409)
+        g.profile_modes = modes
+        if 'memory' in modes:
+            tracemalloc.start(10)
+        if 'cpu' in modes:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+
+def _finish_profile(response):
+    # stop the profilers started for this request and return their report,
+    # or write it to PROFILE_DIRECTORY and name the files in a header
+    modes = g.pop('profile_modes')
+    try:
+        output = io.StringIO()
+        files = []
+        name = '%s-%d-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                             request.path.strip('/').replace('/', '_') or 'root')
+        if 'cpu' in modes:
+            profiler = g.pop('profiler')
+            profiler.disable()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats('cumulative').print_stats(40)
+            if PROFILE_DIRECTORY:
+                os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+                path = os.path.join(PROFILE_DIRECTORY, name + '.prof')
+                stats.dump_stats(path)
+                files.append(path)
+        if 'memory' in modes:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            output.write('traced memory: %d bytes current, %d bytes peak\n' % (current, peak))
+            for statistic in snapshot.statistics('lineno')[:40]:
+                output.write('%s\n' % statistic)
+            if PROFILE_DIRECTORY:
+                os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+                path = os.path.join(PROFILE_DIRECTORY, name + '.memory.txt')
+                with open(path, 'w') as memory_file:
+                    memory_file.write(output.getvalue())
+                files.append(path)
+    finally:
+        _profile_lock.release()
+    if PROFILE_DIRECTORY:
+        response.headers['X-Profile-Files'] = ','.join(files)
+        return response
+    return app.response_class(response=output.getvalue(),
+                              status=response.status_code, mimetype='text/plain')
+
+
+def _log_slow_request(route, response, elapsed):
+    phases = {}
+    for phase, seconds in g.phases.items():
+        phases[phase] = round(seconds, 4)
+    # whatever was not spent on the store or encoding
+    phases['compute'] = round(max(0, elapsed - sum(
+        g.phases.get(phase, 0) for phase in ['lock_wait', 'lock_hold', 'load', 'serialize'])), 4)
+    with _cache_lock:
+        reports = _report_cache['reports']
+    entry = {
+        'time': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'route': route,
+        'method': request.method,
+        'path': request.path,
+        'args': request.args.to_dict(),
+        'status': response.status_code,
+        'seconds': round(elapsed, 4),
+        'reports': len(reports) if reports is not None else None,
+        'phases': phases
+    }
+    if SLOW_REQUEST_LOG:
+        with _metrics_lock:
+            with open(SLOW_REQUEST_LOG, 'a') as log_file:
+                log_file.write(json.dumps(entry, sort_keys=True) + '\n')
+    else:
+        app.logger.warning('slow request %s', json.dumps(entry, sort_keys=True))
+
+
+@app.after_request
+def _record_request(response):
+    # keyed by the route pattern, not the path, so ids do not add series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    key = (route, request.method)
+    elapsed = time.perf_counter() - g.request_started
+    histogram = request_durations.get(key)
+    if histogram is None:
+        with _metrics_lock:
+            histogram = request_durations.setdefault(key, Histogram())
+    histogram.observe(elapsed)
+    key = (route, request.method, response.status_code)
+    with _metrics_lock:
+        request_counts[key] = request_counts.get(key, 0) + 1
+    if SLOW_REQUEST_SECONDS > 0 and elapsed >= SLOW_REQUEST_SECONDS:
+        _log_slow_request(route, response, elapsed)
+    if 'profile_modes' in g:
+        return _finish_profile(response)
+    return response
+
+
+@app.teardown_request
+def _abandon_profile(exception):
+    # a request that failed before _record_request still stops its
+    # profilers
+    if 'profile_modes' in g:
+        modes = g.pop('profile_modes')
+        if 'cpu' in modes:
+            g.pop('profiler').disable()
+        if 'memory' in modes:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+
+def _metric_labels(names, values):
+    labels = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labels.append('%s="%s"' % (name, value))
+    return ','.join(labels)
+
+
+def _metric_histogram(lines, name, help_text, histograms, label_names=()):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s histogram' % name)
+    for values, histogram in histograms:
+        samples, total, count = histogram.samples()
+        labels = _metric_labels(label_names, values)
+        prefix = labels + ',' if labels else ''
+        for bound, cumulative in samples:
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, cumulative))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, suffix, total))
+        lines.append('%s_count%s %d' % (name, suffix, count))
+
+
+def _metric_value(lines, name, metric_type, help_text, value):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    lines.append('%s %r' % (name, value))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text exposition of this worker process
+    lines = []
+    with _metrics_lock:
+        counts = sorted(request_counts.items())
+        durations = sorted(request_durations.items())
+        events = dict(event_counts)
+    lines.append('# HELP http_requests_total Requests answered, by route, method and status.')
+    lines.append('# TYPE http_requests_total counter')
+    for values, count in counts:
+        lines.append('http_requests_total{%s} %d' % (
+            _metric_labels(('route', 'method', 'status'), values), count))
+    _metric_histogram(lines, 'http_request_duration_seconds',
+                      'Time to produce a response, by route and method.',
+                      durations, ('route', 'method'))
+    _metric_histogram(lines, 'store_lock_wait_seconds',
+                      'Time spent waiting for the store lock.', [((), lock_wait)])
+    _metric_histogram(lines, 'store_lock_hold_seconds',
+                      'Time the store lock was held.', [((), lock_hold)])
+    _metric_histogram(lines, 'store_json_decode_seconds',
+                      'Time spent parsing stored reports.', [((), json_decode)])
+    _metric_histogram(lines, 'store_json_encode_seconds',
+                      'Time spent serializing reports for the store.', [((), json_encode)])
+    _metric_histogram(lines, 'response_encode_seconds',
+                      'Time spent encoding response bodies.', [((), response_encode)])
+    _metric_value(lines, 'store_load_retries_total', 'counter',
+                  'Lock-free store reads repeated because the store was replaced meanwhile.',
+                  events['store_load_retries'])
+    _metric_value(lines, 'journal_decode_errors_total', 'counter',
+                  'Partial journal records skipped.', events['journal_decode_errors'])
+    _metric_value(lines, 'event_streams_refused_total', 'counter',
+                  'Event streams and long polls answered 503 past EVENT_STREAMS.',
+                  events['event_streams_refused'])
+    with _cache_lock:
+        hits = cache_stats['hits']
+        misses = cache_stats['misses']
+    _metric_value(lines, 'report_cache_hits_total', 'counter',
+                  'Reads answered from the parsed report cache.', hits)
+    _metric_value(lines, 'report_cache_misses_total', 'counter',
+                  'Reads that loaded the store.', misses)
+    _metric_value(lines, 'report_cache_hit_ratio', 'gauge',
+                  'Share of reads answered from the parsed report cache.',
+                  round(hits / (hits + misses), 4) if hits + misses else 0)
+    hits = events['response_cache_hits']
+    misses = events['response_cache_misses']
+    _metric_value(lines, 'response_cache_hits_total', 'counter',
+                  'GET /report bodies reused from the encoded body cache.', hits)
+    _metric_value(lines, 'response_cache_misses_total', 'counter',
+                  'GET /report bodies encoded.', misses)
+    _metric_value(lines, 'response_cache_hit_ratio', 'gauge',
+                  'Share of GET /report bodies reused from the encoded body cache.',
+                  round(hits / (hits + misses), 4) if hits + misses else 0)
+    _metric_value(lines, 'store_size_bytes', 'gauge',
+                  'Size of the store on disk.', STORE.size())
+    _metric_value(lines, 'reports', 'gauge',
+                  'Reports in the store.', len(read_reports()))
+    return app.response_class(response='\n'.join(lines) + '\n', status=200,
+                              mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/writer', methods=['GET'])
+def writer_status():
+    status = {
+        'group_commit': WRITER is not None,
+        'fsync': REPORT_FSYNC
+    }
+    if WRITER is not None:
+        with WRITER.condition:
+            status.update(copy.deepcopy(WRITER.stats))
+            status['queued'] = len(WRITER.queue)
+        status['interval_ms'] = GROUP_COMMIT_INTERVAL_MS
+        status['batch_size'] = GROUP_COMMIT_BATCH
+        if status['commits'] > 0:
+            status['avg_batch_size'] = round(status['operations'] / status['commits'], 2)
+            status['avg_commit_seconds'] = status['commit_seconds'] / status['commits']
+            status['avg_latency_seconds'] = status['latency_seconds'] / status['operations']
+    return _data_response(status)
+
+
+@app.route('/cache', methods=['GET'])
+def cache_status():
+    with _cache_lock:
+        status = {
+            'generation': _report_cache['generation'],
+            'hits': cache_stats['hits'],
+            'misses': cache_stats['misses'],
+            'loaded': _report_cache['reports'] is not None
+        }
+    return _data_response(status)
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        # server.py migrate [reports.json] imports a JSON store, with its
+        # journal, into the store selected by REPORT_STORE
+        source = JsonFileStore(journal=True)
+        if len(sys.argv) > 2:
+            source = JsonFileStore(report_file=sys.argv[2], journal=True)
+        if isinstance(STORE, JsonFileStore):
+            sys.exit('set REPORT_STORE to the store to migrate into')
+        print('migrated %d reports to %s' %
+              (migrate_reports(source, STORE), REPORT_STORE))
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == 'reshard':
+        # server.py reshard <shards> moves SHARD_DIRECTORY to a new
+        # number of shards
+        print('resharded %d reports into %s shards' %
+              (reshard_reports(SHARD_DIRECTORY, int(sys.argv[2])), sys.argv[2]))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'archive':
+        # server.py archive applies the retention policy once
+        STORE.open()
+        print('archived %d reports to %s' % (archive_reports(), ARCHIVE_DIRECTORY))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'prune-blobs':
+        # server.py prune-blobs removes blobs no report refers to
+        STORE.open()
+        print('removed %d blobs from %s' % (prune_blobs(), BLOB_DIRECTORY))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        # server.py verify checks the summary aggregates and the indexes
+        # against rebuilds and full scans of the store
+        STORE.open()
+        mismatches = verify_summary() + verify_indexes()
+        for mismatch in mismatches:
+            print('mismatch: %s' % (mismatch,))
+        print('%d mismatches' % len(mismatches))
+        sys.exit(1 if mismatches else 0)
+    if SERVER_MODE == 'production':
+        # hand the process over to gunicorn, configured from the
+        # environment by gunicorn.conf.py
+        SERVICE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+        os.execv(sys.executable, [sys.executable, '-m', 'gunicorn',
+                                  '--config', os.path.join(SERVICE_DIRECTORY, 'gunicorn.conf.py'),
+                                  '--pythonpath', SERVICE_DIRECTORY, 'server:app'])
+    STORE.open()
+    start_archiver()
+    # exit normally on SIGTERM so queued writes are committed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    LISTEN_ADDRESS = os.getenv('LISTEN_ADDRESS', '0.0.0.0')
     LISTEN_PORT = os.getenv('LISTEN_PORT', '5000')
-    app.run(host='0.0.0.0', port=int(LISTEN_PORT), threaded=True)
+    app.run(host=LISTEN_ADDRESS, port=int(LISTEN_PORT), threaded=True)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Hammers the configured store with writer processes while reader threads
+# load it without the lock, and fails if any reader sees a torn document.
+#
+#    REPORT_STORE=json ./stress.py [seconds] [writers] [readers]
+#
+import os
+import sys
+import json
+import time
+import uuid
+import tempfile
+import threading
+import multiprocessing
+
+WRITER_PAD = 'x' * 2048
+
+
+def write_reports(seconds, writer):
+    import server
+    deadline = time.time() + seconds
+    report_ids = []
+    while time.time() < deadline:
+        report_id = str(uuid.uuid4())
+        report_ids.append(report_id)
+        server.add_report(report_id, {
+            'zone': 'zone-%d' % writer,
+            'type': 'stress',
+            'image_name': 'stress',
+            'start_time': time.time(),
+            'duration': 0,
+            'results': {},
+            'pad': WRITER_PAD
+        })
+        if len(report_ids) > 50:
+            server.delete_report(report_ids.pop(0))
+
+
+def read_reports(seconds, failures, counts):
+    import server
+    client = server.app.test_client()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            reports, signature = server.STORE.load()
+            for report_id in reports:
+                if reports[report_id]['pad'] != WRITER_PAD:
+                    raise ValueError('report %s is incomplete' % report_id)
+            # the GET /report body, encoded once and shared between requests
+            response = client.get('/report')
+            for report_id, report in json.loads(response.get_data()).items():
+                if report['pad'] != WRITER_PAD:
+                    raise ValueError('listed report %s is incomplete' % report_id)
+            counts.append(len(reports))
+        except Exception as ex:
+            failures.append(repr(ex))
+
+
+def run_stress(seconds=10, writers=4, readers=4):
+    import server
+    server.STORE.open()
+    processes = []
+    for writer in range(writers):
+        process = multiprocessing.Process(target=write_reports,
+                                          args=(seconds, writer))
+        process.start()
+        processes.append(process)
+    failures = []
+    counts = []
+    threads = []
+    for reader in range(readers):
+        thread = threading.Thread(target=read_reports,
+                                  args=(seconds, failures, counts))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+    print('%d reads, %d failures' % (len(counts), len(failures)))
+    for failure in failures[:10]:
+        print(failure)
+    return not failures
+
+
+if __name__ == "__main__":
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    arguments = [int(argument) for argument in sys.argv[1:4]]
+    sys.exit(0 if run_stress(*arguments) else 1)
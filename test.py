@@ -16,17 +16,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import uuid
-import json
+# Concurrent load scenario: NODES simulated harness nodes each run RUNS
+# tests through start, terraform update and stop with the client library,
+# pausing between steps like the harness does, scaled by --pace.
+#
+#    ./test.py [--url http://localhost:5000] [--nodes 20] [--runs 5]
+#        [--pace 0.01] [--spool ./spool] [--asyncio] [--cleanup]
+#
+import sys
 import time
+import uuid
+import random
+import asyncio
+import argparse
 import datetime
-import requests
-import sys
+import threading
+
+from client import ReportClient, AsyncReportClient
 
 one_nic_start = {
     'zone': 'us-south-3',
     'image_name': 'bigip14-1',
-    'test_type': '1nic'
+    'type': '1nic'
 }
 
 one_nic_stop = {
@@ -44,7 +55,7 @@ one_nic_stop = {
 two_nic_start = {
     'zone': 'eu-de-1',
     'image_name': 'bigip14-1',
-    'test_type': '2nic'
+    'type': '2nic'
 }
 
 two_nic_stop = {
@@ -62,7 +73,7 @@ two_nic_stop = {
 three_nic_start = {
     'zone': 'eu-gb-2',
     'image_name': 'bigip14-1',
-    'test_type': '3nic'
+    'type': '3nic'
 }
 
 three_nic_stop = {
@@ -78,51 +89,104 @@ three_nic_stop = {
 }
 
 
-def run_tests():
-    base_url = 'http://localhost:5000'
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    one_nic_uuid = str(uuid.uuid4())
-    requests.post("%s/start/%s" % (base_url, one_nic_uuid),
-                  headers=headers, data=json.dumps(one_nic_start))
-    time.sleep(10)
-    two_nic_uuid = str(uuid.uuid4())
-    requests.post("%s/start/%s" % (base_url, two_nic_uuid),
-                  headers=headers, data=json.dumps(two_nic_start))
-    time.sleep(10)
-    three_nic_uuid = str(uuid.uuid4())
-    requests.post("%s/start/%s" % (base_url, three_nic_uuid),
-                  headers=headers, data=json.dumps(three_nic_start))
+SCENARIOS = [
+    (one_nic_start, one_nic_stop),
+    (two_nic_start, two_nic_stop),
+    (three_nic_start, three_nic_stop)
+]
+
+# seconds the harness spends in each step before it is scaled by --pace
+STEP_SECONDS = [10, 60, 300]
+
+
+def terraform_update():
     now = datetime.datetime.utcnow()
-    update = {
-        'terraform_result_code': '0',
-        'terraform_output':'It worked!',
+    return {
+        'terraform_result_code': 0,
+        'terraform_output': 'It worked!',
+        'terraform_apply_stop': now.timestamp(),
         'terraform_completed_at': now.timestamp(),
         'terraform_completed_at_readable': now.strftime('%Y-%m-%d %H:%M:%S UTC')
     }
-    requests.put("%s/report/%s" % (base_url, one_nic_uuid),
-                 headers=headers, data=json.dumps(update))
-    time.sleep(10)
-    requests.put("%s/report/%s" % (base_url, two_nic_uuid),
-                 headers=headers, data=json.dumps(update))
-    time.sleep(10)
-    requests.put("%s/report/%s" % (base_url, three_nic_uuid),
-                 headers=headers, data=json.dumps(update))
-    time.sleep(60)
-    requests.post("%s/stop/%s" % (base_url, one_nic_uuid),
-                  headers=headers, data=json.dumps(one_nic_stop))
-    time.sleep(10)
-    requests.post("%s/stop/%s" % (base_url, two_nic_uuid),
-                  headers=headers, data=json.dumps(two_nic_stop))
-    time.sleep(10)
-    requests.post("%s/stop/%s" % (base_url, three_nic_uuid),
-                  headers=headers, data=json.dumps(three_nic_stop))
-    time.sleep(300)
-    requests.delete("%s/report/%s" % (base_url, one_nic_uuid))
-    requests.delete("%s/report/%s" % (base_url, two_nic_uuid))
-    requests.delete("%s/report/%s" % (base_url, three_nic_uuid))
+
+
+def run_node(client, runs, pace, test_ids):
+    for run in range(runs):
+        start, stop = random.choice(SCENARIOS)
+        test_id = str(uuid.uuid4())
+        test_ids.append(test_id)
+        client.start(test_id, dict(start))
+        time.sleep(STEP_SECONDS[0] * pace * random.random())
+        client.update(test_id, terraform_update())
+        time.sleep(STEP_SECONDS[1] * pace * random.random())
+        client.stop(test_id, dict(stop))
+        time.sleep(STEP_SECONDS[2] * pace * random.random())
+
+
+async def run_async_node(client, runs, pace, test_ids):
+    for run in range(runs):
+        start, stop = random.choice(SCENARIOS)
+        test_id = str(uuid.uuid4())
+        test_ids.append(test_id)
+        await client.start(test_id, dict(start))
+        await asyncio.sleep(STEP_SECONDS[0] * pace * random.random())
+        await client.update(test_id, terraform_update())
+        await asyncio.sleep(STEP_SECONDS[1] * pace * random.random())
+        await client.stop(test_id, dict(stop))
+        await asyncio.sleep(STEP_SECONDS[2] * pace * random.random())
+
+
+def check_results(client, test_ids, cleanup):
+    # every test should have completed successfully
+    missing = 0
+    for test_id in test_ids:
+        report = client.report(test_id)
+        if report is None or report['results'].get('status') != 'SUCCESS':
+            missing = missing + 1
+    if cleanup:
+        for test_id in test_ids:
+            client.delete(test_id)
+        client.flush()
+    return missing
+
+
+def run_tests(url, nodes, runs, pace, spool=None, use_asyncio=False, cleanup=False):
+    test_ids = []
+    began = time.time()
+    if use_asyncio:
+        async def scenario():
+            async with AsyncReportClient(url, spool_directory=spool) as client:
+                await asyncio.gather(*[run_async_node(client, runs, pace, test_ids)
+                                       for node in range(nodes)])
+        asyncio.get_event_loop().run_until_complete(scenario())
+    else:
+        with ReportClient(url, spool_directory=spool) as client:
+            threads = []
+            for node in range(nodes):
+                thread = threading.Thread(target=run_node,
+                                          args=(client, runs, pace, test_ids))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+    elapsed = time.time() - began
+    with ReportClient(url, spool_directory=spool) as client:
+        missing = check_results(client, test_ids, cleanup)
+        print('%d tests from %d nodes in %.1f seconds, %d spooled, %d incomplete' % (
+            len(test_ids), nodes, elapsed, client.spooled(), missing))
+    return missing == 0
 
 
 if __name__ == "__main__":
-    run_tests()
+    parser = argparse.ArgumentParser(description='Concurrent harness load scenario')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--pace', type=float, default=0.01,
+                        help='fraction of the real time between harness steps')
+    parser.add_argument('--spool', help='directory to spool writes to while the service is down')
+    parser.add_argument('--asyncio', action='store_true', help='use the asyncio client')
+    parser.add_argument('--cleanup', action='store_true', help='delete the tests afterwards')
+    arguments = parser.parse_args()
+    sys.exit(0 if run_tests(arguments.url, arguments.nodes, arguments.runs, arguments.pace,
+                            arguments.spool, arguments.asyncio, arguments.cleanup) else 1)